@@ -0,0 +1,87 @@
+"""
+Fixtures of the benchmarks: phantoms, phantom atlas and stand-in
+registration tools.
+
+The phantom sizes are set by $S3_BENCH_SIZES (comma separated, default
+128), e.g. S3_BENCH_SIZES=128,256,512. Timings are collected by
+pytest-benchmark if it is installed, otherwise by a minimal replacement of
+its `benchmark` fixture that reports the timings at the end of the run.
+"""
+from __future__ import division
+import os
+import sys
+import time
+import pytest
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import phantom  # noqa: E402
+import stand_ins  # noqa: E402
+
+SIZES = [int(size) for size in os.environ.get('S3_BENCH_SIZES', '128').split(',')]
+
+
+@pytest.fixture(scope='session')
+def stand_in_tools(tmp_path_factory):
+    """ Put the stand-in registration tools first on the PATH. """
+
+    bin_dir = stand_ins.install(str(tmp_path_factory.mktemp('bin')))
+    path = os.environ['PATH']
+    os.environ['PATH'] = bin_dir + os.pathsep + path
+    yield bin_dir
+    os.environ['PATH'] = path
+
+
+@pytest.fixture(scope='session')
+def atlas_dir(tmp_path_factory):
+    return phantom.write_atlas(str(tmp_path_factory.mktemp('atlas')))
+
+
+@pytest.fixture(scope='session', params=SIZES, ids=lambda size: '%d^3' % size)
+def phantom_path(request, tmp_path_factory):
+    return phantom.write_phantom(str(tmp_path_factory.mktemp('phantom')), request.param)
+
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+    _timings = []
+
+    class _Benchmark(object):
+        """ Subset of the pytest-benchmark fixture: calling it times a
+        function, pedantic() times it with a setup before every round. """
+
+        def __init__(self, name):
+            self.name = name
+
+        def __call__(self, function, *args, **kwargs):
+            return self.pedantic(function, args, kwargs, rounds=3)
+
+        def pedantic(self, target, args=(), kwargs=None, setup=None, rounds=1, iterations=1):
+            times = []
+            result = None
+            for _ in range(rounds):
+                if setup is not None:
+                    setup_result = setup()
+                    if setup_result is not None:
+                        args, kwargs = setup_result
+                start = time.time()
+                for _ in range(iterations):
+                    result = target(*args, **(kwargs or {}))
+                times.append((time.time() - start) / iterations)
+            _timings.append((self.name, min(times), sum(times) / len(times), len(times)))
+            return result
+
+    @pytest.fixture
+    def benchmark(request):
+        return _Benchmark(request.node.name)
+
+    def pytest_terminal_summary(terminalreporter):
+        if not _timings:
+            return
+        terminalreporter.section('benchmark')
+        terminalreporter.write_line('%-50s %10s %10s %7s' % ('name', 'min (s)', 'mean (s)', 'rounds'))
+        for name, minimum, mean, rounds in _timings:
+            terminalreporter.write_line('%-50s %10.3f %10.3f %7d' % (name, minimum, mean, rounds))
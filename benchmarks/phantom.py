@@ -0,0 +1,127 @@
+"""
+Synthetic head phantoms for the benchmarks.
+
+A phantom is an ellipsoidal head: scalp, skull, cerebrospinal fluid, gray
+matter, white matter and ventricles, with a smooth intensity bias and
+noise. All sizes cover the same 256 mm field of view, so a 128^3 phantom
+has 2 mm voxels and a 512^3 phantom 0.5 mm voxels. The phantom also
+provides a matching atlas (T1, brain mask and tissue probabilities) to
+stand in for the SRI24 atlas.
+
+Usage:
+    python benchmarks/phantom.py out_dir --sizes 128 256 --atlas atlas_dir
+"""
+from __future__ import division
+import argparse
+import os
+import numpy as np
+import nibabel as nib
+
+FIELD_OF_VIEW = 256.  # mm
+# Radii of the head and the tissue boundaries, relative to the head radius
+RADII = {'skull_outer': 0.92, 'skull_inner': 0.85, 'brain': 0.8, 'gm': 0.68, 'ventricles': 0.18}
+# Mean T1 intensity of the tissues
+INTENSITIES = {'scalp': 600, 'skull': 150, 'csf': 250, 'gm': 700, 'wm': 1000}
+# Number of slices computed at once, bounds the memory of large phantoms
+SLAB_SIZE = 32
+
+
+def _affine(size):
+    voxel_size = FIELD_OF_VIEW / size
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.])
+    affine[:3, 3] = -FIELD_OF_VIEW / 2.
+    return affine
+
+
+def _radius(size, start, stop):
+    """ Normalized ellipsoidal radius of the slices start:stop. """
+
+    x, y, z = np.ogrid[0:size, 0:size, start:stop]
+    center = (size - 1) / 2.
+    # head half axes: left-right, anterior-posterior, inferior-superior
+    half_axes = np.array([0.40, 0.47, 0.42]) * size
+    return np.sqrt(((x - center) / half_axes[0]) ** 2 +
+                   ((y - center) / half_axes[1]) ** 2 +
+                   ((z - center) / half_axes[2]) ** 2).astype(np.float32)
+
+
+def _inside(r, radius, width=0.01):
+    """ Soft indicator of r < radius, over about one voxel at 128^3. """
+
+    return 1. / (1. + np.exp(np.clip((r - radius) / width, -50, 50)))
+
+
+def head_phantom(size, seed=0):
+    """ T1 image (int16) of a synthetic head of size^3 voxels.
+
+    Returns the image and a dictionary with the float32 arrays of the brain
+    mask and the wm, gm and csf probabilities.
+    """
+
+    rng = np.random.RandomState(seed)
+    t1 = np.empty((size, size, size), dtype=np.int16)
+    tissues = dict((name, np.empty((size, size, size), dtype=np.float32)) for name in ['mask', 'wm', 'gm', 'csf'])
+
+    for start in range(0, size, SLAB_SIZE):
+        stop = min(start + SLAB_SIZE, size)
+        r = _radius(size, start, stop)
+        brain = _inside(r, RADII['brain'])
+        wm = _inside(r, RADII['gm']) * (1 - _inside(r, RADII['ventricles']))
+        csf = brain - _inside(r, RADII['brain'] - 0.04) + _inside(r, RADII['ventricles'])
+        gm = np.clip(brain - wm - csf, 0, 1)
+        skull = _inside(r, RADII['skull_outer']) - _inside(r, RADII['skull_inner'])
+        scalp = _inside(r, 1.) - _inside(r, RADII['skull_outer'])
+
+        intensity = (INTENSITIES['wm'] * wm + INTENSITIES['gm'] * gm + INTENSITIES['csf'] * csf +
+                     INTENSITIES['skull'] * skull + INTENSITIES['scalp'] * scalp)
+        # smooth bias field and noise
+        intensity *= 1 + 0.1 * np.cos(np.pi * r)
+        intensity += rng.normal(0, 15, intensity.shape) * _inside(r, 1.)
+        t1[:, :, start:stop] = np.clip(intensity, 0, None)
+
+        tissues['mask'][:, :, start:stop] = brain > 0.5
+        tissues['wm'][:, :, start:stop] = wm
+        tissues['gm'][:, :, start:stop] = gm
+        tissues['csf'][:, :, start:stop] = csf
+
+    return nib.Nifti1Image(t1, _affine(size)), tissues
+
+
+def write_phantom(out_dir, size, name='t1', seed=0):
+    """ Save the T1 image of a size^3 phantom as out_dir/name.nii.gz and
+    return its path. """
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    img, _ = head_phantom(size, seed)
+    path = os.path.join(out_dir, '%s.nii.gz' % name)
+    nib.save(img, path)
+
+    return path
+
+
+def write_atlas(atlas_dir, size=128):
+    """ Save an atlas of the phantom (the files of skull.ATLAS_FILES) to
+    atlas_dir and return atlas_dir. """
+
+    if not os.path.exists(atlas_dir):
+        os.makedirs(atlas_dir)
+    img, tissues = head_phantom(size, seed=1)
+    nib.save(img, os.path.join(atlas_dir, 'atlas_t1.nii'))
+    for name in ['mask', 'wm', 'gm', 'csf']:
+        nib.save(nib.Nifti1Image(tissues[name], img.affine), os.path.join(atlas_dir, 'atlas_%s.nii' % name))
+
+    return atlas_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic head phantoms')
+    parser.add_argument('out_dir')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512])
+    parser.add_argument('--atlas', help='folder to write a phantom atlas to')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(write_phantom(args.out_dir, size, name='t1_%d' % size))
+    if args.atlas:
+        print(write_atlas(args.atlas))
@@ -0,0 +1,131 @@
+"""
+Stand-ins for the registration tools used by s3.
+
+The stand-ins accept the command lines of antsRegistration,
+antsApplyTransforms, reg_aladin, reg_f3d and reg_resample as issued by s3
+and write valid outputs of the expected shape (identity transformations,
+images resampled to the reference grid), after an optional delay
+emulating the run time of the real tool. They let the pipeline run on a
+machine without ANTs and NiftyReg, so that the time spent outside the
+registrations can be measured.
+
+The delay in seconds is read from $S3_STAND_IN_DELAY, or per tool from
+e.g. $S3_STAND_IN_DELAY_REG_F3D.
+
+Usage:
+    bin_dir = install('/tmp/stand_ins')
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+"""
+from __future__ import division
+import os
+import shutil
+import stat
+import sys
+import time
+import numpy as np
+import nibabel as nib
+from scipy import io, ndimage
+
+TOOLS = ['antsRegistration', 'antsApplyTransforms', 'reg_aladin', 'reg_f3d', 'reg_resample']
+DELAY_VARIABLE = 'S3_STAND_IN_DELAY'
+# Control point spacing of the reg_f3d stand-in, in voxels of the reference
+CONTROL_POINT_SPACING = 5
+
+
+def install(bin_dir):
+    """ Write an executable for every tool of TOOLS to bin_dir, running this
+    module with the interpreter of the current process. """
+
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, os.path.abspath(__file__), tool))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    return bin_dir
+
+
+def _option(args, name):
+    if name not in args:
+        return None
+    return args[args.index(name) + 1]
+
+
+def _resample(moving_path, reference_path, result_path):
+    """ Linear resampling of the moving image to the grid of the reference,
+    through the world coordinates of both (i.e. an identity transformation). """
+
+    moving = nib.load(moving_path)
+    reference = nib.load(reference_path)
+    data = np.asanyarray(moving.dataobj).astype(np.float32)
+    data = data.reshape(data.shape[:3])
+    voxel_map = np.linalg.inv(moving.affine).dot(reference.affine)
+    resampled = ndimage.affine_transform(data, voxel_map[:3, :3], offset=voxel_map[:3, 3],
+                                         output_shape=reference.shape[:3], order=1)
+    nib.save(nib.Nifti1Image(resampled, reference.affine), result_path)
+
+
+def ants_registration(args):
+    # -o prefix or -o [prefix,result], -m metric[fixed,moving,...]
+    output = _option(args, '-o').strip('[]').split(',')
+    prefix = output[0]
+    if '--write-composite-transform' in args:
+        with open(prefix + 'Composite.h5', 'wb') as f:
+            f.write(b'stand-in composite transformation')
+    elif os.path.isfile(_option(args, '-r')):
+        # registered from an initial transformation: keep it
+        shutil.copyfile(_option(args, '-r'), prefix + '0GenericAffine.mat')
+    else:
+        # ITK affine transformation: 3x3 matrix and translation, and the fixed center
+        parameters = np.concatenate([np.eye(3).ravel(), np.zeros(3)]).reshape(12, 1)
+        io.savemat(prefix + '0GenericAffine.mat',
+                   {'AffineTransform_double_3_3': parameters, 'fixed': np.zeros((3, 1))}, format='4')
+    if len(output) > 1:
+        fixed_path, moving_path = _option(args, '-m').split('[')[1].split(',')[:2]
+        _resample(moving_path, fixed_path, output[1])
+
+
+def ants_apply_transforms(args):
+    _resample(_option(args, '-i'), _option(args, '-r'), _option(args, '-o'))
+
+
+def reg_aladin(args):
+    if _option(args, '-inaff'):
+        shutil.copyfile(_option(args, '-inaff'), _option(args, '-aff'))
+    else:
+        np.savetxt(_option(args, '-aff'), np.eye(4))
+    if _option(args, '-res'):
+        _resample(_option(args, '-flo'), _option(args, '-ref'), _option(args, '-res'))
+
+
+def reg_f3d(args):
+    if _option(args, '-cpp'):
+        reference = nib.load(_option(args, '-ref'))
+        grid = [size // CONTROL_POINT_SPACING + 3 for size in reference.shape[:3]]
+        cpp = np.zeros(grid + [1, 3], dtype=np.float32)
+        nib.save(nib.Nifti1Image(cpp, reference.affine), _option(args, '-cpp'))
+    if _option(args, '-res'):
+        _resample(_option(args, '-flo'), _option(args, '-ref'), _option(args, '-res'))
+
+
+def reg_resample(args):
+    _resample(_option(args, '-flo'), _option(args, '-ref'), _option(args, '-res'))
+
+
+COMMANDS = {'antsRegistration': ants_registration,
+            'antsApplyTransforms': ants_apply_transforms,
+            'reg_aladin': reg_aladin,
+            'reg_f3d': reg_f3d,
+            'reg_resample': reg_resample}
+
+
+def main(tool, args):
+    delay = os.environ.get('%s_%s' % (DELAY_VARIABLE, tool.upper()), os.environ.get(DELAY_VARIABLE, 0))
+    time.sleep(float(delay))
+    COMMANDS[tool](args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,82 @@
+"""
+Benchmarks of the skull stripping pipeline on synthetic phantoms, with
+stand-in registration tools (see stand_ins.py).
+
+Usage:
+    python -m pytest benchmarks
+    S3_BENCH_SIZES=128,256,512 S3_STAND_IN_DELAY=0 python -m pytest benchmarks
+"""
+import os
+import nibabel as nib
+import numpy as np
+import pytest
+
+import phantom
+from src import masks
+from src import moments
+from src.skull import SkullStripper, REFINED_MASK_SIGMAS
+
+
+@pytest.mark.parametrize('preset', ['default', 'fast'])
+def test_strip_skull(benchmark, stand_in_tools, atlas_dir, phantom_path, preset, tmp_path):
+    rounds = []
+
+    def setup():
+        output_path = str(tmp_path / ('run%d' % len(rounds)))
+        rounds.append(output_path)
+        os.makedirs(output_path)
+        skull_stripper = SkullStripper(phantom_path, output_path, want_tissues=True, want_atlas=False,
+                                       cache=None, preset=preset, atlas_dir=atlas_dir)
+        return (skull_stripper,), {}
+
+    benchmark.pedantic(SkullStripper.strip_skull, setup=setup, rounds=1)
+
+    assert os.path.isfile(os.path.join(rounds[-1], 't1_masked.nii.gz'))
+    assert os.path.isfile(os.path.join(rounds[-1], 't1_s3_report.json'))
+
+
+def test_apply_mask(benchmark, atlas_dir, phantom_path, tmp_path):
+    img, tissues = phantom.head_phantom(nib.load(phantom_path).shape[0])
+    mask = nib.Nifti1Image(tissues['mask'].astype(np.uint8), img.affine)
+    skull_stripper = SkullStripper(phantom_path, str(tmp_path), False, False, atlas_dir=atlas_dir)
+
+    path = benchmark(skull_stripper.apply_mask, phantom_path, mask, 't1_masked')
+
+    assert nib.load(path).shape == img.shape
+
+
+def test_refined_mask(benchmark, phantom_path):
+    img, tissues = phantom.head_phantom(nib.load(phantom_path).shape[0])
+    basic_mask = tissues['mask'].astype(np.uint8)
+    tissue_maps = [tissues[name] for name in ['csf', 'gm', 'wm']]
+
+    def fuse_and_refine():
+        soft_mask = masks.fuse_tissues(tissue_maps, basic_mask)
+        return masks.refine_mask(soft_mask, REFINED_MASK_SIGMAS, out=soft_mask)
+
+    mask = benchmark(fuse_and_refine)
+
+    assert mask.shape == img.shape
+
+
+def test_sweep_cutoffs(benchmark, phantom_path):
+    img, tissues = phantom.head_phantom(nib.load(phantom_path).shape[0])
+    soft_mask = masks.fuse_tissues([tissues[name] for name in ['csf', 'gm', 'wm']], tissues['mask'])
+    n_sigmas = np.linspace(0.5, 5, 46)
+
+    bounds, counts = benchmark(masks.sweep_cutoffs, soft_mask, n_sigmas, [1, 5, 10])
+
+    # the counts of the sweep are those of the refined masks
+    assert counts[list(n_sigmas).index(REFINED_MASK_SIGMAS)] == masks.refine_mask(soft_mask, REFINED_MASK_SIGMAS).sum()
+
+
+def test_moment_alignment(benchmark, phantom_path):
+    img = nib.load(phantom_path)
+    # the phantom turned by 90 degrees about the z axis and shifted
+    pose = np.array([[0, -1, 0, 12], [1, 0, 0, -7], [0, 0, 1, 5], [0, 0, 0, 1]], dtype=float)
+    moved = nib.Nifti1Image(np.asanyarray(img.dataobj), pose.dot(img.affine))
+
+    world = benchmark(moments.moment_alignment, img, moved)
+
+    # the world transformation from the phantom to the moved phantom is the pose
+    assert np.allclose(world, pose, atol=1e-3)
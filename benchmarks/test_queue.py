@@ -0,0 +1,90 @@
+"""
+Benchmark of the lease queue: several worker processes sharing one queue
+folder, as the workers of several nodes would.
+
+Usage:
+    python -m pytest benchmarks/test_queue.py
+    S3_QUEUE_WORKERS=4 S3_QUEUE_SUBJECTS=8 python -m pytest benchmarks/test_queue.py
+
+A second benchmark reuses the queue folder after the scan of a subject
+changed, as a rerun of a cohort would, and checks that it is processed
+again.
+"""
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import nibabel as nib
+import numpy as np
+
+from src import cohort
+from src import lease
+
+S3 = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 's3.py')
+WORKERS = int(os.environ.get('S3_QUEUE_WORKERS', 2))
+SUBJECTS = int(os.environ.get('S3_QUEUE_SUBJECTS', 4))
+
+
+def _run_workers(cohort_dir, queue_dir, output_dir, atlas_dir):
+    workers = [subprocess.Popen([sys.executable, S3, '--batch', cohort_dir, '-n', 't1.nii.gz', '-o', output_dir,
+                                 '--queue', queue_dir, '--atlas', atlas_dir, '--no-cache',
+                                 '--report', os.path.join(output_dir, 'report%d.json' % worker)],
+                                stdout=subprocess.DEVNULL)
+               for worker in range(WORKERS)]
+    return [worker.wait() for worker in workers]
+
+
+def test_queue(benchmark, stand_in_tools, atlas_dir, phantom_path, tmp_path):
+    cohort_dir = tmp_path / 'cohort'
+    inputs = []
+    for subject in range(SUBJECTS):
+        subject_dir = cohort_dir / ('s%d' % subject)
+        subject_dir.mkdir(parents=True)
+        os.symlink(phantom_path, str(subject_dir / 't1.nii.gz'))
+        inputs.append(str(subject_dir / 't1.nii.gz'))
+
+    # the lease of a crashed worker, to be reclaimed
+    queue_dir = str(tmp_path / 'queue')
+    abandoned = lease.LeaseQueue(queue_dir).lease_path(inputs[0])
+    with open(abandoned, 'w') as f:
+        f.write('{}')
+    os.utime(abandoned, (0, 0))
+
+    output_dir = str(tmp_path / 'output')
+    returncodes = benchmark.pedantic(_run_workers, args=(str(cohort_dir), queue_dir, output_dir, atlas_dir),
+                                     rounds=1)
+
+    assert returncodes == [0] * WORKERS
+    assert sorted(os.listdir(queue_dir)) == sorted(lease.subject_key(path) + '.done' for path in inputs)
+    # every subject was processed exactly once
+    reports = [json.load(open(path)) for path in glob.glob(os.path.join(output_dir, 'report*.json'))]
+    assert sorted(report['input'] for worker in reports for report in worker['subjects']) == sorted(inputs)
+
+
+def _run_cohort(cohort_dir, queue_dir, output_dir, atlas_dir, index_path):
+    return subprocess.call([sys.executable, S3, '--batch', cohort_dir, '-n', 't1.nii.gz', '-o', output_dir,
+                            '--queue', queue_dir, '--cohort', index_path, '--atlas', atlas_dir, '--no-cache',
+                            '--report', os.path.join(output_dir, 'report.json')], stdout=subprocess.DEVNULL)
+
+
+def test_queue_changed_scan(benchmark, stand_in_tools, atlas_dir, phantom_path, tmp_path):
+    subject_dir = tmp_path / 'cohort' / 's0'
+    subject_dir.mkdir(parents=True)
+    scan = str(subject_dir / 't1.nii.gz')
+    shutil.copyfile(phantom_path, scan)
+    args = (str(tmp_path / 'cohort'), str(tmp_path / 'queue'), str(tmp_path / 'output'), atlas_dir,
+            str(tmp_path / 'cohort.db'))
+    assert _run_cohort(*args) == 0
+
+    # the scan is replaced: the queue folder is reused, its marker belongs to the old scan
+    img = nib.load(scan)
+    nib.save(nib.Nifti1Image(np.asanyarray(img.dataobj) * 2, img.affine), scan)
+    returncode = benchmark.pedantic(_run_cohort, args=args, rounds=1)
+
+    assert returncode == 0
+    report = json.load(open(str(tmp_path / 'output' / 'report.json')))
+    assert [subject['input'] for subject in report['subjects']] == [scan]
+    assert [row['state'] for row in cohort.CohortIndex(args[4]).scans()] == ['done']
@@ -0,0 +1,39 @@
+"""
+Benchmarks of the start up of the command line interface.
+
+Usage:
+    python -m pytest benchmarks/test_startup.py
+"""
+import os
+import subprocess
+import sys
+
+S3 = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 's3.py')
+# Modules that must not be imported to show the help or to submit a job
+HEAVY_MODULES = ['numpy', 'nibabel', 'scipy', 'nilearn', 'sklearn']
+
+
+def _imported_modules(args):
+    """ Top level modules imported by `python s3.py args`. """
+
+    process = subprocess.run([sys.executable, '-X', 'importtime', S3] + args,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    modules = set()
+    for line in process.stderr.decode().splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return modules
+
+
+def test_help_startup(benchmark):
+    benchmark.pedantic(subprocess.run, args=([sys.executable, S3, '--help'],),
+                       kwargs={'stdout': subprocess.PIPE, 'check': True}, rounds=5)
+
+
+def test_help_imports():
+    assert not set(HEAVY_MODULES) & _imported_modules(['--help'])
+
+
+def test_pipeline_import(benchmark):
+    benchmark.pedantic(subprocess.run, args=([sys.executable, '-c', 'import src.skull'],),
+                       kwargs={'cwd': os.path.dirname(S3), 'check': True}, rounds=3)
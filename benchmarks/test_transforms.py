@@ -0,0 +1,71 @@
+"""
+Tests of the affine transformations of the registration tools: the ITK
+.mat files of ANTs in LPS coordinates with a center of rotation, and the
+reg_aladin .txt files, against transformations worked out by hand.
+
+Usage:
+    python -m pytest benchmarks/test_transforms.py
+"""
+import nibabel as nib
+import numpy as np
+from scipy import io
+
+from src import transforms
+
+# LPS rotation by 90 degrees about z, translation and center of rotation of an ITK affine transformation
+ITK_MATRIX = np.array([[0., -1., 0.], [1., 0., 0.], [0., 0., 1.]])
+ITK_TRANSLATION = np.array([5., -3., 2.])
+ITK_CENTER = np.array([10., 20., -4.])
+# y = M (x - c) + c + t in LPS, i.e. M x + (35, 7, 2); x and y are flipped to RAS
+EXPECTED_WORLD = np.array([[0., -1., 0., -35.],
+                           [1., 0., 0., -7.],
+                           [0., 0., 1., 2.],
+                           [0., 0., 0., 1.]])
+
+
+def _write_ants_mat(path):
+    parameters = np.concatenate([ITK_MATRIX.ravel(), ITK_TRANSLATION]).reshape(12, 1)
+    io.savemat(path, {'AffineTransform_double_3_3': parameters, 'fixed': ITK_CENTER.reshape(3, 1)}, format='4')
+
+
+def test_read_itk_affine(benchmark, tmp_path):
+    path = str(tmp_path / 'aff0GenericAffine.mat')
+    _write_ants_mat(path)
+
+    world = benchmark(transforms.read_itk_affine, path)
+
+    assert np.allclose(world, EXPECTED_WORLD)
+
+
+def test_resample_itk_affine(benchmark, tmp_path):
+    path = str(tmp_path / 'aff0GenericAffine.mat')
+    _write_ants_mat(path)
+    world = transforms.read_itk_affine(path)
+
+    # a bright voxel of the moving image, at RAS (-40, 13, 10): the image of the reference voxel (20, 5, 8)
+    moving_affine = np.eye(4)
+    moving_affine[:3, 3] = -50.
+    moving = np.zeros((80, 80, 80), dtype=np.float32)
+    moving[10, 63, 60] = 1.
+    reference = nib.Nifti1Image(np.zeros((40, 40, 40), dtype=np.float32), np.eye(4))
+
+    resampled, = benchmark(transforms.resample_affine, [nib.Nifti1Image(moving, moving_affine)], reference, world)
+
+    data = np.asanyarray(resampled.dataobj)
+    assert data[20, 5, 8] == 1.
+    assert data.sum() == 1.
+
+
+def test_write_affine_round_trip(tmp_path):
+    itk_path = str(tmp_path / 'initial.mat')
+    niftyreg_path = str(tmp_path / 'initial.txt')
+
+    transforms.write_itk_affine(EXPECTED_WORLD, itk_path)
+    transforms.write_niftyreg_affine(EXPECTED_WORLD, niftyreg_path)
+
+    assert np.allclose(transforms.read_itk_affine(itk_path), EXPECTED_WORLD)
+    assert np.allclose(transforms.read_niftyreg_affine(niftyreg_path), EXPECTED_WORLD)
+    # the written file holds the LPS transformation about the origin
+    parameters = io.loadmat(itk_path)['AffineTransform_double_3_3'].ravel()
+    assert np.allclose(parameters[:9].reshape(3, 3), ITK_MATRIX)
+    assert np.allclose(parameters[9:], [35., 7., 2.])
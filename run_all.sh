@@ -1,7 +1,5 @@
 #!/bin/sh
 
-for file in APT/*
-do
-echo "Processing folder:" ${file}
-python s3.py -i ${file}/MPR_reg.nii.gz -t -a
-done
+# Skull strip every subject folder in APT/ with 4 subjects processed at a time,
+# only the subjects that are new or changed since the last run (see apt.db)
+python s3.py --batch APT -n MPR_reg.nii.gz -t -a --jobs 4 --cohort apt.db
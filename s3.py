@@ -1,16 +1,61 @@
-from src.skull import SkullStripper
 from src import helpers as utils
 import os
+import sys
 import time
 
+# numpy, nibabel and the pipeline are imported where they are needed, so
+# that --help and --submit start quickly
+
+USAGE = """Usage:
+    python s3.py -i <input> [-o <output folder>] [options]
+    python s3.py --batch <folder or manifest> [-n <scan name>] [--jobs <n>] [--cohort <db>] [--queue <folder>]
+                 [options]
+    python s3.py --cohort <db>
+    python s3.py --sweep <soft mask> [--sigmas <list>] [--percentiles <list>] [--sweep-masks]
+    python s3.py --serve <socket> [--jobs <n>] [options]
+    python s3.py --submit <socket> -i <input> [-o <output folder>] [options]
+
+Options:
+    -t                    save the wm, gm and csf maps
+    -a                    save the atlas registered to the input
+    -m <paths>            comma separated further modalities to mask
+    --preset <name>       fast, default or accurate
+    --atlas <path>        atlas folder or atlas pack
+    --rigid-backend       ants or niftyreg
+    --deformable-backend  niftyreg or ants
+    --threads <n>         threads of the registration tools
+    --scratch <folder>    folder (or 'tmpfs') for intermediate files
+    --cache <folder>      registration cache folder
+    --cache-size <GB>     maximal size of the registration cache
+    --no-cache            do not use the registration cache
+    --in-memory           keep intermediate images in memory
+    --compression <0-9>   compression level of the outputs, 0: uncompressed .nii
+    --tissue-type <type>  uint8, uint16 or float32 tissue maps
+    --no-intermediates    don't save the soft mask and other intermediate outputs
+    --report <path>       cohort report of a batch
+    --cohort <db>         cohort index: process only new or changed scans, or show its state
+    --queue <folder>      share the batch with the workers of other nodes through lease files
+    --sigmas <list>       comma separated refined mask cutoffs to sweep, in standard deviations
+    --percentiles <list>  comma separated refined mask cutoffs to sweep, as percentiles
+    --sweep-masks         save the mask of every swept cutoff
+    -h, --help            show this help
+
+See README.md for details."""
+
 if __name__ == '__main__':
 
     from sys import argv
 
     myargs = utils.getopts(argv)
 
+    if '-h' in myargs or '--help' in myargs or len(argv) == 1:
+        print(USAGE)
+        sys.exit(0)
+
     want_tissues = False
     want_atlas = False
+    in_memory = False
+    output_path = None
 
     if '-i' in myargs:
         input_path = myargs['-i']
@@ -26,11 +71,129 @@ if __name__ == '__main__':
     if '-a' in myargs:
         want_atlas = True
 
+    if '--in-memory' in myargs:
+        in_memory = True
+
+    preset = myargs.get('--preset', 'default')
+    atlas_dir = myargs.get('--atlas')
+    rigid_backend = myargs.get('--rigid-backend', 'ants')
+    deformable_backend = myargs.get('--deformable-backend', 'niftyreg')
+
+    companions = []
+    if '-m' in myargs:
+        companions = myargs['-m'].split(',')
+
+    scratch_root = None
+    if '--scratch' in myargs:
+        scratch_root = myargs['--scratch']
+
+    # output encoding, SkullStripper defaults unless given
+    output_options = {}
+    if '--compression' in myargs:
+        output_options['compression'] = int(myargs['--compression'])
+    if '--tissue-type' in myargs:
+        output_options['tissue_type'] = myargs['--tissue-type']
+    if '--no-intermediates' in myargs:
+        output_options['keep_intermediates'] = False
+
+    threads = None
+    if '--threads' in myargs:
+        threads = int(myargs['--threads'])
+
+    if '--submit' in myargs:
+        from src import service
+        start = time.time()
+        job = service.submit(myargs['--submit'], input_path, output_path, want_tissues=want_tissues,
+                             want_atlas=want_atlas, preset=preset, companion_paths=companions, in_memory=in_memory,
+                             **output_options)
+        if not job['ok']:
+            print(job['error'])
+            sys.exit(1)
+        print("Job %d %s: %s" % (job['job'], job['state'], job['input']))
+        if job['state'] == 'failed':
+            print(job['result']['error'])
+        print('Done (' + str((time.time() - start) / 60.) + ' min)')
+        sys.exit(0 if job['state'] == 'done' else 1)
+
+    if '--sweep' in myargs:
+        from src import sweep
+        n_sigmas = [float(n) for n in myargs['--sigmas'].split(',')] if '--sigmas' in myargs else None
+        percentiles = [float(p) for p in myargs['--percentiles'].split(',')] if '--percentiles' in myargs else None
+        # the sweep writes masks only: the tissue type and intermediates don't apply
+        sweep_options = dict((key, value) for key, value in output_options.items() if key == 'compression')
+        results = sweep.run_sweep(myargs['--sweep'], n_sigmas, percentiles, save_masks='--sweep-masks' in myargs,
+                                  **sweep_options)
+        sweep.print_sweep(results)
+        sys.exit(0)
+
+    if '--cohort' in myargs and '--batch' not in myargs:
+        from src import cohort
+        index = cohort.CohortIndex(myargs['--cohort'])
+        cohort.print_status(index)
+        index.close()
+        sys.exit(0)
+
+    from src import batch
+    from src.cache import RegistrationCache
+
+    cache = None
+    if '--no-cache' not in myargs:
+        cache_size = float(myargs.get('--cache-size', 2))
+        cache = RegistrationCache(myargs.get('--cache'), max_size=int(cache_size * 1024 ** 3))
+
+    if '--serve' in myargs:
+        from src import service
+        service.serve(myargs['--serve'], jobs=int(myargs.get('--jobs', 1)), threads=threads,
+                      scratch_root=scratch_root, cache=cache, atlas_dir=atlas_dir,
+                      rigid_backend=rigid_backend, deformable_backend=deformable_backend, **output_options)
+        sys.exit(0)
+
+    if '--batch' in myargs:
+        jobs = int(myargs.get('--jobs', 1))
+        inputs = batch.find_inputs(myargs['--batch'], myargs.get('-n'), companions)
+        options = dict(want_tissues=want_tissues, want_atlas=want_atlas, scratch_root=scratch_root, cache=cache,
+                       in_memory=in_memory, preset=preset, atlas_dir=atlas_dir, rigid_backend=rigid_backend,
+                       deformable_backend=deformable_backend, **output_options)
+        on_result = None
+        if '--cohort' in myargs:
+            # only the new, changed, failed and outdated scans
+            from src import cohort
+            index = cohort.CohortIndex(myargs['--cohort'])
+            changes = index.update(inputs)
+            index_options = dict(options, companions=companions)
+            all_inputs = len(inputs)
+            inputs = index.pending(inputs, index_options)
+            print("Cohort index: %d new and %d changed scans, %d of %d scans to process \n"
+                  % (changes['new'], changes['changed'], len(inputs), all_inputs))
+            on_result = lambda result: index.record(result, index_options)
+        start = time.time()
+        if '--queue' in myargs:
+            from src import lease
+            results = lease.run_queue(inputs, myargs['--queue'], output_path, jobs=jobs, threads=threads,
+                                      companions=companions, on_result=on_result, **options)
+        else:
+            results = batch.run_batch(inputs, output_path, jobs=jobs, threads=threads, companions=companions,
+                                      on_result=on_result, **options)
+        batch.print_summary(results)
+        report_path = myargs.get('--report', os.path.join(output_path or os.getcwd(), 's3_cohort_report.json'))
+        batch.save_cohort_report(results, report_path)
+        print('Done (' + str((time.time() - start) / 60.) + ' min)')
+        sys.exit(0 if all(result['success'] for result in results) else 1)
+
+    if threads is not None:
+        batch.set_thread_count(threads)
+
     if not os.path.exists(output_path):
         print("The selected output folder doesn't exist, so I am making it \n")
         os.makedirs(output_path)
 
+    from src.skull import SkullStripper
+
     start = time.time()
-    skull_stripper = SkullStripper(input_path, output_path, want_tissues, want_atlas)
+    skull_stripper = SkullStripper(input_path, output_path, want_tissues, want_atlas,
+                                   scratch_root=scratch_root, cache=cache,
+                                   in_memory=in_memory, companion_paths=companions, preset=preset,
+                                   atlas_dir=atlas_dir, rigid_backend=rigid_backend,
+                                   deformable_backend=deformable_backend, **output_options)
     skull_stripper.strip_skull()
     print('Done (' + str((time.time() - start) / 60.) + ' min)')
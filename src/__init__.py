@@ -0,0 +1,2 @@
+# Version of the pipeline, increased whenever its outputs change (see cohort.py)
+__version__ = '1.2.0'
@@ -0,0 +1,197 @@
+"""
+Atlas pack: all atlas channels in one versioned, memory-mappable file.
+
+The pack holds the atlas T1, brain mask and tissue maps (see CHANNELS),
+cropped to the brain with a margin that keeps the skull, in compact data
+types (uint8 mask and tissue probabilities, int16 or quantized uint16 T1),
+and a pyramid of downsampled copies for low resolution registrations.
+
+Layout of the file:
+
+    MAGIC (8 bytes) | header length (uint64, little endian) | json header |
+    arrays, each starting at a multiple of ALIGNMENT bytes
+
+The header records the version, the grid (shape, affine) of every pyramid
+level, the data type, offset and scaling of every array, and a sha256
+checksum of the arrays, which keys the registration cache. Arrays are
+stored in Fortran order, like nifti, and are read through memory maps, so
+concurrent workers on one node share one copy in the page cache.
+
+Usage:
+    python -m src.atlas src/Atlas src/Atlas/atlas.s3pack
+    pack = load_pack('src/Atlas/atlas.s3pack')
+    t1 = pack.image('t1', level=1)
+"""
+from __future__ import division
+import hashlib
+import json
+import os
+import struct
+import sys
+import numpy as np
+import nibabel as nib
+from nibabel.arrayproxy import ArrayProxy
+from . import nifti_io
+from . import roi
+
+MAGIC = b'S3ATLAS\0'
+VERSION = 1
+ALIGNMENT = 4096
+# Channel names and the nifti files they are built from
+CHANNELS = {'t1': 'atlas_t1.nii', 'mask': 'atlas_mask.nii', 'wm': 'atlas_wm.nii', 'gm': 'atlas_gm.nii',
+            'csf': 'atlas_csf.nii'}
+# Margin (mm) around the brain kept by the crop, enough for skull and scalp
+CROP_MARGIN = 25.
+# Downsampling factors of the pyramid levels
+PYRAMID_FACTORS = [1, 2, 4]
+
+_packs = {}
+
+
+def _quantize(name, data):
+    """ Compact data type, slope and intercept of a channel. """
+
+    if name != 't1':
+        # probabilities (and the binary mask) in [0, 1] as uint8
+        quantized, slope = nifti_io.quantize(data, np.uint8)
+        return quantized, slope, 0.
+
+    info = np.iinfo(np.int16)
+    if np.all(data == np.round(data)) and data.min() >= info.min and data.max() <= info.max:
+        return data.astype(np.int16), 1., 0.
+    low, high = float(data.min()), float(data.max())
+    slope = (high - low) / 65535 if high > low else 1.
+    return np.round((data - low) / slope).astype(np.uint16), slope, low
+
+
+def build_pack(atlas_dir, pack_path):
+    """ Write the pack of the atlas nifti files (see CHANNELS) in
+    atlas_dir to pack_path. """
+
+    images = dict((name, nib.load(os.path.join(atlas_dir, file_name))) for name, file_name in CHANNELS.items())
+    mask = np.asanyarray(images['mask'].dataobj)
+    mask = mask.reshape(mask.shape[:3])
+    zooms = np.array(images['mask'].header.get_zooms()[:3], dtype=float)
+    box = roi.bounding_box(mask > 0.5, pad=int(np.ceil(CROP_MARGIN / zooms.min())))
+
+    levels = []
+    arrays = []
+    for level, factor in enumerate(PYRAMID_FACTORS):
+        level_images = {}
+        for name, img in images.items():
+            cropped = roi.crop(img, box)
+            level_images[name] = cropped if factor == 1 else roi.downsample(cropped, zooms.min() * factor)
+        reference = level_images['mask']
+        levels.append({'shape': [int(size) for size in reference.shape[:3]],
+                       'affine': reference.affine.tolist()})
+        for name in sorted(level_images):
+            data = np.asanyarray(level_images[name].dataobj).astype(np.float64).reshape(reference.shape[:3])
+            quantized, slope, inter = _quantize(name, data)
+            arrays.append(({'channel': name, 'level': level, 'dtype': quantized.dtype.str,
+                            'slope': slope, 'inter': inter}, quantized))
+
+    # offsets relative to the data section, fixed once the header size is known
+    sha = hashlib.sha256()
+    offset = 0
+    for entry, data in arrays:
+        entry['offset'] = offset
+        offset += -(-data.nbytes // ALIGNMENT) * ALIGNMENT
+        sha.update(data.tobytes(order='F'))
+    header = {'version': VERSION, 'source': os.path.abspath(atlas_dir), 'levels': levels,
+              'factors': PYRAMID_FACTORS, 'arrays': [entry for entry, _ in arrays], 'checksum': sha.hexdigest()}
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = pack_path + '.tmp%d' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for entry, data in arrays:
+            f.seek(data_start + entry['offset'])
+            f.write(data.tobytes(order='F'))
+    os.replace(tmp_path, pack_path)
+
+    return pack_path
+
+
+class AtlasPack(object):
+    """ Read access to an atlas pack (see the module docstring).
+
+    Parameters
+    ----------
+    path : str
+        path to the pack
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not an atlas pack' % path)
+            header_size, = struct.unpack('<Q', f.read(8))
+            self.header = json.loads(f.read(header_size).decode())
+        if self.header['version'] != VERSION:
+            raise ValueError('%s has version %s, expected %d' % (path, self.header['version'], VERSION))
+        self.data_start = -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+        self.arrays = dict(((entry['channel'], entry['level']), entry) for entry in self.header['arrays'])
+
+    @property
+    def checksum(self):
+        """ Identifies the content of the pack, e.g. for cache keys. """
+
+        return 'pack%d:%s' % (self.header['version'], self.header['checksum'])
+
+    @property
+    def levels(self):
+        return len(self.header['levels'])
+
+    def voxel_size(self, level):
+        affine = np.array(self.header['levels'][level]['affine'])
+        return float(np.sqrt((affine[:3, :3] ** 2).sum(axis=0)).min())
+
+    def level_for(self, voxel_size):
+        """ Finest level whose voxels are not smaller than voxel_size (mm),
+        the coarsest level if none; level 0 if voxel_size is None. """
+
+        if voxel_size is None:
+            return 0
+        for level in range(self.levels):
+            if self.voxel_size(level) >= voxel_size - 1e-6:
+                return level
+        return self.levels - 1
+
+    def image(self, channel, level=0):
+        """ Channel as a nibabel image; the voxel data is memory-mapped and
+        scaled to float when accessed. """
+
+        entry = self.arrays[(channel, level)]
+        grid = self.header['levels'][level]
+        proxy = ArrayProxy(self.path, (tuple(grid['shape']), np.dtype(entry['dtype']),
+                                       self.data_start + entry['offset'], entry['slope'], entry['inter']),
+                           mmap='r')
+        return nib.Nifti1Image(proxy, np.array(grid['affine']))
+
+    def save(self, channel, path, level=0):
+        """ Write a channel as a nifti file, e.g. for a registration tool. """
+
+        img = self.image(channel, level)
+        nib.save(nib.Nifti1Image(np.asanyarray(img.dataobj).astype(np.float32), img.affine), path)
+        return path
+
+
+def load_pack(path):
+    """ AtlasPack of path, opened once per process. """
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _packs:
+        _packs[key] = AtlasPack(path)
+    return _packs[key]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python -m src.atlas <atlas folder> <pack path>')
+        sys.exit(1)
+    print(build_pack(sys.argv[1], sys.argv[2]))
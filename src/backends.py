@@ -0,0 +1,342 @@
+"""
+Registration backends.
+
+A backend wraps one registration package behind the same three
+operations, so that every registration stage can use either package:
+
+    affine    : affine registration (translation, rigid, affine)
+    nonrigid  : deformable registration, initialized with an affine one
+    resample  : application of a transformation of the same backend
+
+    ants     : antsRegistration / antsApplyTransforms (ITK .mat affine,
+               composite .h5 deformation)
+    niftyreg : reg_aladin / reg_f3d / reg_resample (.txt affine, control
+               point grid deformation)
+
+The binaries are looked up once, on the PATH and in the install folders
+($ANTSPATH, $NIFTYREG_INSTALL/bin, paths.registration_dir). The tools are
+run without a shell; their output is appended to a log file, and a failing
+tool raises a RegistrationError with the end of its output.
+
+Usage:
+    backend = get_backend('niftyreg', log_path='registration.log')
+    backend.affine(atlas_path, image_path, 'aff.txt', preset=presets.get_preset('default'))
+    backend.resample(mask_path, image_path, 'aff.txt', 'mask_reg.nii.gz')
+"""
+from __future__ import division
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from . import paths
+from . import profiling
+from . import transforms
+
+# Environment variables controlling the thread pools of ITK (ANTs) and OpenMP (NiftyReg)
+TOOL_THREAD_VARIABLES = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS']
+# Maximal number of resampling commands running at the same time
+RESAMPLE_JOBS = int(os.environ.get('S3_RESAMPLE_JOBS', 4))
+# Lines of the tool output quoted by a RegistrationError
+ERROR_LINES = 20
+
+_binaries = {}
+
+
+class ToolNotFoundError(RuntimeError):
+    pass
+
+
+class RegistrationError(RuntimeError):
+    """ A registration tool exited with an error. """
+
+    def __init__(self, tool, returncode, output):
+        self.tool = tool
+        self.returncode = returncode
+        self.output = output
+        tail = '\n'.join(output.splitlines()[-ERROR_LINES:])
+        super(RegistrationError, self).__init__('%s failed with exit code %d:\n%s' % (tool, returncode, tail))
+
+
+def find_binary(tool, search_dirs=()):
+    """ Path of the executable `tool` on the PATH or in one of search_dirs,
+    None if not found. Results are remembered for the lifetime of the
+    process. """
+
+    key = (tool, tuple(search_dirs))
+    if key not in _binaries:
+        binary = shutil.which(tool)
+        for search_dir in search_dirs:
+            if binary is not None:
+                break
+            binary = shutil.which(tool, path=search_dir)
+        _binaries[key] = binary
+
+    return _binaries[key]
+
+
+class Backend(object):
+    """ Registration package, see the module docstring.
+
+    Parameters
+    ----------
+    threads : int
+        threads of every tool, by default the inherited environment decides
+    log_path : str
+        file the output of the tools is appended to, discarded if None
+    """
+
+    name = None
+    # tools of the package and folders to search them in besides the PATH
+    TOOLS = []
+    SEARCH_DIRS = []
+    # file extensions of the affine and the deformable transformations
+    AFFINE_EXTENSION = None
+    NONRIGID_EXTENSION = None
+
+    def __init__(self, threads=None, log_path=None):
+        self.threads = threads
+        self.log_path = log_path
+        search_dirs = [d for d in self.SEARCH_DIRS if d]
+        self.binaries = dict((tool, find_binary(tool, search_dirs)) for tool in self.TOOLS)
+
+    def _run(self, tool, args):
+        """ Run a tool of the backend with a list of arguments. """
+
+        binary = self.binaries[tool]
+        if binary is None:
+            search_dirs = ['the PATH'] + [d for d in self.SEARCH_DIRS if d]
+            raise ToolNotFoundError('%s not found in %s' % (tool, ', '.join(search_dirs)))
+
+        env = dict(os.environ)
+        if self.threads is not None:
+            for variable in TOOL_THREAD_VARIABLES:
+                env[variable] = str(self.threads)
+
+        process = subprocess.Popen([binary] + [str(arg) for arg in args], env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        with process.stdout:
+            output = process.stdout.read().decode('utf-8', 'replace')
+        # wait4 reports the resource usage of this tool alone, see profiling.record_tool
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        profiling.record_tool(rusage)
+        if self.log_path is not None:
+            with open(self.log_path, 'a') as log:
+                log.write('$ %s %s\n%s\n' % (tool, ' '.join(str(arg) for arg in args), output))
+        if process.returncode != 0:
+            raise RegistrationError(tool, process.returncode, output)
+
+    def affine(self, moving_path, fixed_path, transform_path, result_path=None, preset=None, initial=None):
+        """ Affine registration of the moving to the fixed image.
+
+        Parameters
+        ----------
+        moving_path : str
+            .nii or .nii.gz path to the moving image
+        fixed_path : str
+            .nii or .nii.gz path to the reference image
+        transform_path : str
+            result path of the transformation (AFFINE_EXTENSION)
+        result_path : str
+            .nii or .nii.gz path of the registered moving image, optional
+        preset : dict
+            registration parameters, see presets.py
+        initial : array
+            4x4 world transformation from fixed to moving space to start
+            from (see moments.py), by default the tool's own initialization
+        """
+
+        raise NotImplementedError
+
+    def nonrigid(self, moving_path, fixed_path, affine_path, transform_path, result_path=None, preset=None):
+        """ Deformable registration of the moving to the fixed image,
+        initialized with an affine transformation of the same backend. The
+        resulting transformation includes the affine one.
+
+        Parameters
+        ----------
+        affine_path : str
+            initial affine transformation (AFFINE_EXTENSION)
+        transform_path : str
+            result path of the transformation (NONRIGID_EXTENSION)
+        others :
+            see affine
+        """
+
+        raise NotImplementedError
+
+    def resample(self, moving_path, fixed_path, transform_path, result_path):
+        """ Apply a transformation of this backend (affine or deformable) to
+        the moving image, on the grid of the fixed image (linear
+        interpolation). """
+
+        raise NotImplementedError
+
+    def read_affine(self, transform_path):
+        """ World (RAS) transformation from fixed to moving space of an
+        affine transformation of this backend, see transforms.py. """
+
+        raise NotImplementedError
+
+    def write_affine(self, world, transform_path):
+        """ Write a world transformation from fixed to moving space as an
+        affine transformation of this backend. """
+
+        raise NotImplementedError
+
+    def nonrigid_extension(self, nifti_extension='.nii.gz'):
+        """ File extension of the nonrigid transformations: nifti_extension
+        ('.nii' or '.nii.gz') if they are images (control point grids). """
+
+        if self.NONRIGID_EXTENSION.startswith('.nii'):
+            return nifti_extension
+        return self.NONRIGID_EXTENSION
+
+    def _initial_path(self, transform_path):
+        # the initial transformation is written next to the result
+        return os.path.splitext(transform_path)[0] + '_initial' + self.AFFINE_EXTENSION
+
+    def resample_many(self, jobs, max_workers=None):
+        """ Run independent resample calls concurrently.
+
+        Parameters
+        ----------
+        jobs : list of tuple
+            arguments of one resample call each
+        max_workers : int
+            maximal number of concurrent processes, defaults to
+            $S3_RESAMPLE_JOBS (4)
+        """
+
+        if max_workers is None:
+            max_workers = RESAMPLE_JOBS
+        max_workers = max(1, min(max_workers, len(jobs)))
+
+        # the work is done by the tool processes, threads suffice
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(self.resample, *job) for job in jobs]
+            for future in futures:
+                future.result()
+
+
+class AntsBackend(Backend):
+
+    name = 'ants'
+    TOOLS = ['antsRegistration', 'antsApplyTransforms']
+    SEARCH_DIRS = [os.environ.get('ANTSPATH')]
+    AFFINE_EXTENSION = '.mat'
+    NONRIGID_EXTENSION = '.h5'
+
+    def _register(self, stages, fixed_path, moving_path, transform_path, result_path, initial, suffix):
+        # antsRegistration names its outputs after a prefix, register in a temporary folder
+        out_dir = tempfile.mkdtemp(prefix='.ants_', dir=os.path.dirname(os.path.abspath(transform_path)))
+        try:
+            prefix = os.path.join(out_dir, 'reg_')
+            output = prefix if result_path is None else '[%s,%s]' % (prefix, result_path)
+            args = ['-d', 3, '-r', initial] + stages + ['-o', output]
+            if suffix == 'Composite.h5':
+                args += ['--write-composite-transform', 1]
+            self._run('antsRegistration', args)
+            shutil.move(prefix + suffix, transform_path)
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    def affine(self, moving_path, fixed_path, transform_path, result_path=None, preset=None, initial=None):
+        metric = 'mattes[%s,%s,1,32,regular,%%s]' % (fixed_path, moving_path)
+        stages = []
+        if initial is None:
+            # initialize by aligning the centers of mass, then search the translation
+            iterations = preset['ants_iterations'] if preset else '10000x1111x5'
+            initial_transform = '[%s,%s,1]' % (fixed_path, moving_path)
+            stages += ['-m', metric % 0.05, '-t', 'translation[0.1]', '-c', '[1000,1.e-8,20]',
+                       '-s', '4vox', '-f', 6, '-l', 1]
+        else:
+            iterations = preset['ants_moment_iterations'] if preset else '1000x500x5'
+            initial_transform = self.write_affine(initial, self._initial_path(transform_path))
+        stages += ['-m', metric % 0.1, '-t', 'rigid[0.1]', '-c', '[1000x1000,1.e-8,20]',
+                   '-s', '4x2vox', '-f', '4x2', '-l', 1,
+                   '-m', metric % 0.1, '-t', 'affine[0.1]', '-c', '[%s,1.e-8,20]' % iterations,
+                   '-s', '4x2x1vox', '-f', '3x2x1', '-l', 1]
+        try:
+            self._register(stages, fixed_path, moving_path, transform_path, result_path, initial_transform,
+                           '0GenericAffine.mat')
+        finally:
+            if initial is not None:
+                os.remove(initial_transform)
+
+    def nonrigid(self, moving_path, fixed_path, affine_path, transform_path, result_path=None, preset=None):
+        iterations = preset['syn_iterations'] if preset else '100x70x20'
+        stages = ['-m', 'cc[%s,%s,1,4]' % (fixed_path, moving_path), '-t', 'SyN[0.1,3,0]',
+                  '-c', '[%s,1.e-6,10]' % iterations, '-s', '2x1x0vox', '-f', '4x2x1', '-l', 1]
+        self._register(stages, fixed_path, moving_path, transform_path, result_path, affine_path,
+                       'Composite.h5')
+
+    def read_affine(self, transform_path):
+        return transforms.read_itk_affine(transform_path)
+
+    def write_affine(self, world, transform_path):
+        return transforms.write_itk_affine(world, transform_path)
+
+    def resample(self, moving_path, fixed_path, transform_path, result_path):
+        self._run('antsApplyTransforms', ['-d', 3, '-i', moving_path, '-r', fixed_path, '-t', transform_path,
+                                          '-o', result_path, '--float', 1])
+
+
+class NiftyRegBackend(Backend):
+
+    name = 'niftyreg'
+    TOOLS = ['reg_aladin', 'reg_f3d', 'reg_resample']
+    SEARCH_DIRS = [os.path.join(os.environ['NIFTYREG_INSTALL'], 'bin') if 'NIFTYREG_INSTALL' in os.environ else None,
+                   paths.registration_dir]
+    AFFINE_EXTENSION = '.txt'
+    NONRIGID_EXTENSION = '.nii.gz'
+
+    @staticmethod
+    def _result_path(result_path, transform_path):
+        # without -res the tools write outputResult.nii to the working folder (not read, so not compressed)
+        if result_path is None:
+            result_path = os.path.splitext(transform_path)[0] + '_result.nii'
+        return result_path
+
+    def affine(self, moving_path, fixed_path, transform_path, result_path=None, preset=None, initial=None):
+        args = ['-flo', moving_path, '-ref', fixed_path, '-aff', transform_path,
+                '-res', self._result_path(result_path, transform_path)]
+        if initial is not None:
+            args += ['-inaff', self.write_affine(initial, self._initial_path(transform_path))]
+        if preset:
+            args += preset['aladin_params']
+        try:
+            self._run('reg_aladin', args)
+        finally:
+            if initial is not None:
+                os.remove(self._initial_path(transform_path))
+
+    def nonrigid(self, moving_path, fixed_path, affine_path, transform_path, result_path=None, preset=None):
+        args = ['-flo', moving_path, '-ref', fixed_path, '-aff', affine_path, '-cpp', transform_path,
+                '-res', self._result_path(result_path, transform_path)]
+        if preset:
+            args += preset['f3d_params']
+        self._run('reg_f3d', args)
+
+    def read_affine(self, transform_path):
+        return transforms.read_niftyreg_affine(transform_path)
+
+    def write_affine(self, world, transform_path):
+        return transforms.write_niftyreg_affine(world, transform_path)
+
+    def resample(self, moving_path, fixed_path, transform_path, result_path):
+        transform_flag = '-aff' if transform_path.endswith(self.AFFINE_EXTENSION) else '-cpp'
+        self._run('reg_resample', ['-flo', moving_path, '-ref', fixed_path, transform_flag, transform_path,
+                                   '-res', result_path])
+
+
+BACKENDS = {'ants': AntsBackend, 'niftyreg': NiftyRegBackend}
+
+
+def get_backend(name, threads=None, log_path=None):
+    """ Backend `name` (ants or niftyreg), see Backend for the arguments. """
+
+    if name not in BACKENDS:
+        raise ValueError('Unknown registration backend %s, choose one of %s' % (name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name](threads=threads, log_path=log_path)
@@ -0,0 +1,335 @@
+"""
+Batch (cohort) skull stripping.
+
+Drives many SkullStripper runs through a pool of worker processes, so the
+interpreter and the numpy/nibabel imports are paid once per worker instead
+of once per subject.
+
+Usage:
+    inputs = find_inputs('APT', input_name='MPR_reg.nii.gz')
+    results = run_batch(inputs, output_root=None, jobs=4)
+    print_summary(results)
+    save_cohort_report(results, 's3_cohort_report.json')
+"""
+from __future__ import division
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import re
+import sys
+import time
+import traceback
+from . import profiling
+
+# Environment variables controlling the thread pools of the registration
+# tools (ANTs/ITK, NiftyReg/OpenMP) and of numpy's BLAS backend
+THREAD_VARIABLES = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+                    'OMP_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS']
+
+NIFTI_EXTENSIONS = ('.nii', '.nii.gz')
+# Outputs of a run (see skull.py and sweep.py), written next to the input by default: not inputs
+OUTPUT_PATTERN = re.compile(r'_(mask(_basic|_soft|_refined_reg|_sigma[0-9.]+|_pct[0-9.]+)?|masked(_basic)?'
+                            r'|atlas_reg_deform|csf|gm|wm)\.nii(\.gz)?$')
+# Suffix of the work folders, which earlier versions kept in the output folder
+WORK_SUFFIX = '_s3_work'
+# Seconds between two checks for worker processes that died (e.g. killed by the OOM killer)
+WORKER_CHECK_INTERVAL = 5
+
+
+def is_nifti(path):
+    return path.endswith(NIFTI_EXTENSIONS)
+
+
+def is_output(path):
+    """ True for the files a run writes next to its input. """
+
+    return OUTPUT_PATTERN.search(os.path.basename(path)) is not None
+
+
+def find_inputs(batch_path, input_name=None, companions=None):
+    """ Collect the input scans of a cohort.
+
+    Parameters
+    ----------
+    batch_path : str
+        either a directory or a manifest file. A manifest lists one input
+        scan per line (relative paths are taken relative to the manifest,
+        lines starting with '#' are ignored).
+    input_name : str
+        if batch_path is a directory, the file name of the scan inside
+        every subject folder (e.g. 'MPR_reg.nii.gz'). If None, every nifti
+        file in the directory and in its direct subfolders is taken, except
+        the outputs of earlier runs (see is_output), the companions and the
+        work folders.
+    companions : list of str
+        file names of the companion modalities, which are not inputs
+    """
+
+    if os.path.isfile(batch_path):
+        base_dir = os.path.dirname(os.path.abspath(batch_path))
+        inputs = []
+        with open(batch_path) as manifest:
+            for line in manifest:
+                line = line.strip()
+                if len(line) == 0 or line.startswith('#'):
+                    continue
+                inputs.append(os.path.join(base_dir, line))
+        return inputs
+
+    if not os.path.isdir(batch_path):
+        raise ValueError(batch_path + ' is neither a folder nor a manifest')
+
+    def is_input(path):
+        return (is_nifti(path) and not is_output(path)
+                and os.path.basename(path) not in (companions or []))
+
+    inputs = []
+    for entry in sorted(os.listdir(batch_path)):
+        entry_path = os.path.join(os.path.abspath(batch_path), entry)
+        if os.path.isdir(entry_path):
+            if entry.endswith(WORK_SUFFIX):
+                continue
+            if input_name is not None:
+                candidates = [input_name]
+            else:
+                candidates = [name for name in sorted(os.listdir(entry_path)) if is_input(name)]
+            for candidate in candidates:
+                path = os.path.join(entry_path, candidate)
+                if os.path.isfile(path) and is_nifti(path):
+                    inputs.append(path)
+        elif input_name is None and is_input(entry_path):
+            inputs.append(entry_path)
+
+    return inputs
+
+
+def thread_budget(jobs, threads=None):
+    """ Number of threads each of the `jobs` concurrent subjects may use,
+    so that jobs x threads does not exceed the cores of the node. """
+
+    if threads is not None:
+        return max(1, int(threads))
+    return max(1, multiprocessing.cpu_count() // max(1, jobs))
+
+
+def set_thread_count(threads):
+    """ Limit the ITK, OpenMP and BLAS thread pools of this process and of
+    every registration tool it launches. """
+
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+
+
+def get_output_path(input_path, output_root=None):
+    """ Output folder of a subject: next to the input scan, or a folder
+    named after the subject folder inside output_root. """
+
+    input_dir = os.path.dirname(os.path.abspath(input_path))
+    if output_root is None:
+        return input_dir
+    return os.path.join(os.path.abspath(output_root), os.path.basename(input_dir))
+
+
+@contextlib.contextmanager
+def _redirect_output(log_path):
+    """ Send stdout/stderr of this process, including the output of the
+    registration tools it launches, to log_path. """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(log_path, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+# Queue on which the workers announce the task they start, see imap_guarded
+_started = None
+
+
+def _init_worker(threads, started=None):
+    global _started
+    set_thread_count(threads)
+    _started = started
+
+
+def _run_task(job):
+    index, function, task = job
+    if _started is not None:
+        _started.put((index, os.getpid()))
+    return index, function(task)
+
+
+def imap_guarded(function, tasks, jobs, threads, lost_result):
+    """ Results of function(task) for all tasks, in the order they finish,
+    from `jobs` worker processes with `threads` threads each (see
+    set_thread_count). A task whose worker process died (e.g. killed by the
+    OOM killer) yields lost_result(task), where multiprocessing.Pool alone
+    would wait for it forever. """
+
+    started = multiprocessing.Queue()
+    finished = queue.Queue()
+    workers = {}  # task index -> pid of the worker that started it
+    left = set(range(len(tasks)))
+    suspects = set()
+    lost = False
+    pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(threads, started))
+    try:
+        for index, task in enumerate(tasks):
+            pool.apply_async(_run_task, ((index, function, task),), callback=finished.put)
+        while left:
+            try:
+                index, result = finished.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                while True:
+                    try:
+                        index, pid = started.get_nowait()
+                    except queue.Empty:
+                        break
+                    workers[index] = pid
+                alive = set(process.pid for process in multiprocessing.active_children())
+                dead = set(index for index in left if index in workers and workers[index] not in alive)
+                # a result may still be on its way when its worker exited: lost at the second check
+                for index in sorted(dead & suspects):
+                    left.discard(index)
+                    lost = True
+                    yield lost_result(tasks[index])
+                suspects = dead - suspects
+                continue
+            left.discard(index)
+            yield result
+    finally:
+        # the pool waits for the results of lost tasks forever
+        if left or lost:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+
+def lost_subject(task):
+    """ Result of strip_subject for a subject whose worker process died. """
+
+    return {'input': task[0], 'output': task[1], 'success': False, 'report': None, 'minutes': 0.,
+            'error': 'WorkerLost: the worker process died (e.g. out of memory)'}
+
+
+def strip_subject(task):
+    """ Skull strip one subject; never raises, so that a bad scan does not
+    stop the cohort. Returns a dictionary describing the outcome. """
+
+    input_path, output_path, options = task
+
+    start = time.time()
+    result = {'input': input_path, 'output': output_path, 'success': False, 'error': None, 'report': None}
+    skull_stripper = None
+    try:
+        from .skull import SkullStripper
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        name = os.path.splitext(os.path.splitext(os.path.basename(input_path))[0])[0]
+        log_path = os.path.join(output_path, name + '_s3.log')
+        with _redirect_output(log_path):
+            skull_stripper = SkullStripper(input_path, output_path, **options)
+            skull_stripper.strip_skull()
+        result['success'] = True
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    if skull_stripper is not None and skull_stripper.report is not None:
+        result['report'] = skull_stripper.report.to_dict()
+    result['minutes'] = (time.time() - start) / 60.
+
+    return result
+
+
+def make_tasks(inputs, output_root=None, companions=None, options=None):
+    """ Tasks of strip_subject for the inputs, see run_batch for the
+    arguments. """
+
+    tasks = []
+    for path in inputs:
+        subject_options = dict(options or {})
+        if companions:
+            input_dir = os.path.dirname(os.path.abspath(path))
+            subject_options['companion_paths'] = [os.path.join(input_dir, name) for name in companions]
+        tasks.append((path, get_output_path(path, output_root), subject_options))
+    return tasks
+
+
+def run_batch(inputs, output_root=None, jobs=1, threads=None, companions=None, on_result=None, **options):
+    """ Skull strip all inputs with `jobs` worker processes.
+
+    Parameters
+    ----------
+    inputs : list of str
+        paths to the input scans
+    output_root : str
+        root of the output folders, see get_output_path
+    jobs : int
+        number of subjects processed concurrently
+    threads : int
+        threads per subject; by default the cores are divided among jobs
+    companions : list of str
+        file names of further modalities in the folder of every input scan,
+        the brain mask of the input is applied to them as well
+    on_result : callable
+        called with the result of every subject as soon as it finished,
+        e.g. to record it in a cohort index
+    options :
+        keyword arguments passed on to SkullStripper
+    """
+
+    threads = thread_budget(jobs, threads)
+    print("Processing %d subjects, %d at a time with %d threads each \n"
+          % (len(inputs), jobs, threads))
+
+    tasks = make_tasks(inputs, output_root, companions, options)
+    results = []
+    for result in imap_guarded(strip_subject, tasks, jobs, threads, lost_subject):
+        status = 'done' if result['success'] else 'FAILED'
+        print("[%d/%d] %s: %s (%.1f min)" % (len(results) + 1, len(tasks), status,
+                                             result['input'], result['minutes']))
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    return results
+
+
+def print_summary(results):
+    """ Print which subjects succeeded and why the others failed. """
+
+    failed = [result for result in results if not result['success']]
+    print('---------------------------\nBatch Finished.')
+    print("%d subjects succeeded, %d failed \n" % (len(results) - len(failed), len(failed)))
+    for result in failed:
+        print("FAILED %s\n    %s" % (result['input'], result['error']))
+
+
+def save_cohort_report(results, path):
+    """ Save the run reports of all subjects and their per-stage aggregate
+    (see profiling.aggregate) to a json file, and print the mean stage
+    times. """
+
+    reports = [result['report'] for result in results if result['report'] is not None]
+    summary = profiling.aggregate(reports)
+    print("Mean time per stage over %d subjects:" % summary['subjects'])
+    profiling.print_aggregate(summary)
+
+    with open(path, 'w') as f:
+        json.dump({'summary': summary, 'subjects': reports}, f, indent=2)
+    print("Cohort report saved to %s \n" % path)
@@ -0,0 +1,183 @@
+"""
+On-disk cache of atlas registrations.
+
+The registration steps dominate the run time of skull stripping, but
+their results only depend on the input scan, the atlas and the
+registration parameters. The cache stores the resulting transformations
+(ANTs affine .mat, NiftyReg affine .txt and control point grid) under a
+key hashed from these, so a rerun with e.g. a different mask threshold
+skips the initial registration. The registrations of the skull stripped
+atlas are keyed by the content of the images they register instead,
+which depend on the initial registration and on the mask. The least
+recently used entries are evicted once the cache exceeds its maximal
+size.
+
+Usage:
+    cache = RegistrationCache()
+    key = cache.key('nonrigid', hash_image(input_path), hash_files(atlas_paths))
+    if not cache.fetch(key, {'cpp.nii.gz': cpp_path}):
+        ... compute cpp_path ...
+        cache.store(key, {'cpp.nii.gz': cpp_path})
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+
+# Environment variable selecting the cache folder if none is given
+CACHE_VARIABLE = 'S3_CACHE_DIR'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 's3', 'registrations')
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3  # bytes
+
+_file_hashes = {}
+
+
+def hash_image(path):
+    """ Hash of the voxel data and the header of a nifti image. """
+
+    img = nib.load(path)
+    sha = hashlib.sha256()
+    sha.update(img.header.binaryblock)
+    sha.update(np.ascontiguousarray(np.asanyarray(img.dataobj)).data)
+
+    return sha.hexdigest()
+
+
+def hash_files(paths):
+    """ Hash of the content of files, e.g. the atlas files. Hashes are
+    remembered as long as the size and modification time don't change. """
+
+    sha = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        signature = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        if signature not in _file_hashes:
+            file_sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    file_sha.update(block)
+            _file_hashes[signature] = file_sha.hexdigest()
+        sha.update(_file_hashes[signature].encode())
+
+    return sha.hexdigest()
+
+
+class RegistrationCache(object):
+    """ Content addressed store of registration results.
+
+    Every entry is a folder named after its key, holding the cached files.
+    Entries are written atomically (renamed into place when complete) and
+    their modification time records the last use, for LRU eviction.
+
+    Parameters
+    ----------
+    root : str
+        cache folder, defaults to $S3_CACHE_DIR or ~/.cache/s3/registrations
+    max_size : int
+        maximal total size in bytes of the cached files
+    """
+
+    def __init__(self, root=None, max_size=DEFAULT_MAX_SIZE):
+        if root is None:
+            root = os.environ.get(CACHE_VARIABLE, DEFAULT_CACHE_DIR)
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+
+    def key(self, *parts):
+        """ Key hashed from the given parts (hashes, parameters, ...). """
+
+        sha = hashlib.sha256()
+        for part in parts:
+            sha.update(str(part).encode())
+            sha.update(b'\0')
+
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def fetch(self, key, files):
+        """ Copy cached files to their destinations.
+
+        Parameters
+        ----------
+        key : str
+            key of the entry
+        files : dict
+            maps the names of cached files to destination paths
+
+        Returns True if the entry holds all files, False otherwise.
+        """
+
+        entry = self._entry(key)
+        cached = [os.path.join(entry, name) for name in files]
+        if not all(os.path.isfile(path) for path in cached):
+            return False
+
+        for name, path in files.items():
+            shutil.copyfile(os.path.join(entry, name), path)
+        try:
+            os.utime(entry, None)
+        except OSError:  # evicted meanwhile, the copies are complete
+            pass
+
+        return True
+
+    def store(self, key, files):
+        """ Store files under key (replacing an existing entry) and evict
+        the least recently used entries if the cache grew too large.
+
+        Parameters
+        ----------
+        key : str
+            key of the entry
+        files : dict
+            maps the names of cached files to the paths to copy them from
+        """
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp_', dir=self.root)
+        for name, path in files.items():
+            shutil.copyfile(path, os.path.join(tmp_entry, name))
+
+        entry = self._entry(key)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:  # stored concurrently by another run
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits into
+        max_size. """
+
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                last_use = os.path.getmtime(entry)
+            except OSError:
+                continue
+            entries.append((last_use, size, entry))
+            total_size += size
+
+        for last_use, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        """ Remove all entries. """
+
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,119 @@
+"""
+Checkpointing of the skull stripping stages.
+
+A manifest (json) in the work folder of a run records the stages that
+completed and the files they produced. A rerun of the same input with
+the same options resumes from the first stage that is not recorded or
+whose files disappeared. Files are written under a temporary name and
+renamed into place, so a killed process never leaves a half-written file
+behind under a final name.
+
+Usage:
+    manifest = Manifest(os.path.join(work_dir, 'manifest.json'), run_info)
+    if not manifest.is_complete('rigid'):
+        ... compute outputs ...
+        manifest.complete('rigid', outputs)
+"""
+import contextlib
+import json
+import os
+import shutil
+import nibabel as nib
+
+
+def _tmp_path(path):
+    """ Temporary path next to `path`, with the same extension (nibabel
+    chooses the file format by extension). """
+
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.tmp%d_%s' % (os.getpid(), basename))
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """ Temporary path to write to, renamed to `path` if the with block
+    completes and removed otherwise. """
+
+    tmp_path = _tmp_path(path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_save(img, path):
+    """ Save a nibabel image so that `path` is either absent or complete. """
+
+    with atomic_path(path) as tmp_path:
+        nib.save(img, tmp_path)
+
+
+def publish(src_path, path):
+    """ Move a file written elsewhere (e.g. by a registration tool into the
+    scratch folder) atomically to `path`. """
+
+    tmp_path = _tmp_path(path)
+    try:
+        shutil.move(src_path, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class Manifest(object):
+    """ Record of the completed stages of a run.
+
+    Parameters
+    ----------
+    path : str
+        path to the manifest (.json)
+    run_info : dict
+        description of the run (input, options). A manifest written for a
+        different run_info is discarded.
+    """
+
+    def __init__(self, path, run_info):
+        self.path = path
+        self.run_info = run_info
+        self.stages = {}
+
+        if os.path.isfile(path):
+            with open(path) as f:
+                content = json.load(f)
+            if content.get('run') == run_info:
+                self.stages = content['stages']
+
+    def is_complete(self, stage):
+        """ True if the stage completed and all its files still exist.
+        Outputs that were only kept in memory (path None) are lost, such a
+        stage needs to be recomputed. """
+
+        if stage not in self.stages:
+            return False
+        return all(path is not None and os.path.exists(path) for path in self.stages[stage].values())
+
+    def outputs(self, stage):
+        return dict(self.stages[stage])
+
+    def complete(self, stage, outputs):
+        """ Record that the stage completed with the given output files. """
+
+        self.stages[stage] = dict(outputs)
+        self._write()
+
+    def reset(self, stages):
+        """ Forget the given stages, e.g. all stages following one that
+        needs to be recomputed. """
+
+        for stage in stages:
+            self.stages.pop(stage, None)
+        self._write()
+
+    def _write(self):
+        tmp_path = _tmp_path(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump({'run': self.run_info, 'stages': self.stages}, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,167 @@
+"""
+Cohort index.
+
+A SQLite database of the input scans of a cohort: the path, size,
+modification time and content hash of every scan, the state of its last
+skull stripping run, its output folder, and the pipeline version
+(src.__version__) and options that produced the outputs. A batch run with
+an index only processes the scans that are new, changed, failed before,
+or were processed by another version or with other options. Unchanged
+scans are recognized by their size and modification time, so they are
+not read again; a scan that was only touched keeps its state. The state
+of the cohort is queried from the index, without walking the tree.
+
+Keep the database on a local disk, SQLite locking is not reliable on NFS.
+
+Usage:
+    python s3.py --batch APT -n MPR_reg.nii.gz --cohort apt.db
+    python s3.py --cohort apt.db
+"""
+from __future__ import division
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from . import __version__
+
+# Options of a run that change its outputs, scans processed with other values are processed again
+OUTPUT_OPTIONS = ['want_tissues', 'want_atlas', 'in_memory', 'preset', 'atlas_dir', 'rigid_backend',
+                  'deformable_backend', 'companions', 'compression', 'tissue_type', 'keep_intermediates']
+# States of a scan: new or changed since its last run, processed ('done') or 'failed'
+STATES = ['new', 'changed', 'done', 'failed']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    input TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT NOT NULL,
+    state TEXT NOT NULL,
+    output TEXT,
+    version TEXT,
+    options TEXT,
+    error TEXT,
+    minutes REAL,
+    updated REAL NOT NULL
+)
+"""
+
+
+def hash_file(path):
+    """ sha256 of the content of a file. """
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def options_key(options):
+    """ The OUTPUT_OPTIONS of a run as a json string. """
+
+    return json.dumps(dict((name, options.get(name)) for name in OUTPUT_OPTIONS), sort_keys=True)
+
+
+class CohortIndex(object):
+    """ Index of the scans of a cohort (see the module docstring).
+
+    Parameters
+    ----------
+    path : str
+        path to the SQLite database, created if it doesn't exist
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, inputs):
+        """ Add new scans to the index and detect changed ones, by their
+        size and modification time first and their content hash second.
+        Returns the number of new and changed scans. """
+
+        counts = {'new': 0, 'changed': 0}
+        now = time.time()
+        with self.connection:
+            for path in inputs:
+                path = os.path.abspath(path)
+                stat = os.stat(path)
+                row = self.connection.execute('SELECT size, mtime, hash FROM scans WHERE input = ?',
+                                              (path,)).fetchone()
+                if row is not None and (row['size'], row['mtime']) == (stat.st_size, stat.st_mtime):
+                    continue
+                content_hash = hash_file(path)
+                if row is None:
+                    self.connection.execute('INSERT INTO scans (input, size, mtime, hash, state, updated) '
+                                            'VALUES (?, ?, ?, ?, ?, ?)',
+                                            (path, stat.st_size, stat.st_mtime, content_hash, 'new', now))
+                    counts['new'] += 1
+                elif row['hash'] == content_hash:
+                    # touched, not changed
+                    self.connection.execute('UPDATE scans SET size = ?, mtime = ? WHERE input = ?',
+                                            (stat.st_size, stat.st_mtime, path))
+                else:
+                    self.connection.execute('UPDATE scans SET size = ?, mtime = ?, hash = ?, state = ?, '
+                                            'updated = ? WHERE input = ?',
+                                            (stat.st_size, stat.st_mtime, content_hash, 'changed', now, path))
+                    counts['changed'] += 1
+        return counts
+
+    def pending(self, inputs, options):
+        """ The inputs that are not indexed as done by this version with
+        these options (see options_key), in the given order. """
+
+        done = set(row['input'] for row in self.connection.execute(
+            'SELECT input FROM scans WHERE state = ? AND version = ? AND options = ?',
+            ('done', __version__, options_key(options))))
+        return [path for path in inputs if os.path.abspath(path) not in done]
+
+    def record(self, result, options):
+        """ Record the result of batch.strip_subject for a scan. """
+
+        with self.connection:
+            self.connection.execute('UPDATE scans SET state = ?, output = ?, version = ?, options = ?, error = ?, '
+                                    'minutes = ?, updated = ? WHERE input = ?',
+                                    ('done' if result['success'] else 'failed', result['output'], __version__,
+                                     options_key(options), result['error'], result.get('minutes'), time.time(),
+                                     os.path.abspath(result['input'])))
+
+    def scans(self, state=None):
+        """ Rows (dictionaries) of all scans, or of the scans in a state. """
+
+        query = 'SELECT * FROM scans'
+        params = ()
+        if state is not None:
+            query += ' WHERE state = ?'
+            params = (state,)
+        return [dict(row) for row in self.connection.execute(query + ' ORDER BY input', params)]
+
+    def summary(self):
+        """ Number of scans per state; done scans of another pipeline
+        version are counted as 'outdated'. """
+
+        counts = dict((state, 0) for state in STATES + ['outdated'])
+        for row in self.connection.execute('SELECT state, version = ? AS current, COUNT(*) AS n FROM scans '
+                                           'GROUP BY state, current', (__version__,)):
+            state = 'outdated' if row['state'] == 'done' and not row['current'] else row['state']
+            counts[state] += row['n']
+        return counts
+
+
+def print_status(index):
+    """ Print the number of scans per state and the failed scans. """
+
+    counts = index.summary()
+    print("Cohort index %s (s3 %s): %d scans" % (index.path, __version__, sum(counts.values())))
+    for state in STATES + ['outdated']:
+        print("    %-9s %d" % (state, counts[state]))
+    for row in index.scans('failed'):
+        print("FAILED %s\n    %s" % (row['input'], row['error']))
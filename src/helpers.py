@@ -1,10 +1,13 @@
-import inspect
 import os
 
+# Options that are switches and do not take a value
+FLAGS = ['-t', '-a', '--no-cache', '--in-memory', '--no-intermediates', '--sweep-masks', '-h', '--help']
+# Folder of the package, relative paths are taken relative to it
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 
 def get_relative_path(file_path):
-    dirname = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
-    file_path = os.path.join(dirname, file_path)
+    file_path = os.path.join(PACKAGE_DIR, file_path)
 
     return file_path
 
@@ -13,9 +16,7 @@ def getopts(argv):
     opts = {}  # Empty dictionary to store key-value pairs.
     while argv:  # While there are arguments left to parse...
         if argv[0][0] == '-':  # Found a "-name value" pair.
-            if argv[0][1] == "t":
-                opts[argv[0]] = 1
-            elif argv[0][1] == "a":
+            if argv[0] in FLAGS:
                 opts[argv[0]] = 1
             else:
                 opts[argv[0]] = argv[1]  # Add key and value to the dictionary.
@@ -0,0 +1,258 @@
+"""
+Lease queue: coordinator-free distribution of a cohort over any number of
+worker processes, on any number of nodes sharing a folder.
+
+Every subject has a key: its folder name and a hash of the path, size
+and modification time of its scan, so that a scan changed since it was
+processed gets a new key and is processed again. A worker claims a subject by creating the lease file <key>.lease in the
+queue folder with O_CREAT | O_EXCL, which succeeds for one worker only,
+and keeps the lease alive by touching it every HEARTBEAT_INTERVAL
+seconds. When the subject is finished the worker writes the marker
+<key>.done or <key>.failed (the result of batch.strip_subject as json)
+and removes its lease. A lease not touched for LEASE_EXPIRY seconds
+belongs to a crashed worker: another worker reclaims it by renaming it
+to a name of its own, which succeeds for one worker only, and claims the
+subject again. Workers poll until every subject has a marker, so
+subjects of workers that crash late are still picked up. A subject whose
+worker process dies (e.g. out of memory) is marked as failed.
+
+The workers compare lease times with their own clock, so the clocks of
+the nodes must be synchronized (e.g. by NTP) to well within LEASE_EXPIRY.
+
+Usage (on every node, with the same queue folder):
+    python s3.py --batch APT -n MPR_reg.nii.gz --queue /shared/apt_queue --jobs 4
+"""
+from __future__ import division
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from . import batch
+
+# Seconds between two touches of a held lease
+HEARTBEAT_INTERVAL = 30
+# Seconds after the last touch at which a lease is taken as abandoned
+LEASE_EXPIRY = 300
+# Seconds between two passes over subjects leased by other workers
+POLL_INTERVAL = 5
+MARKERS = ['done', 'failed']
+
+
+def subject_key(input_path):
+    """ File name stem of the lease and markers of a subject, which changes
+    with the size or modification time of its scan. """
+
+    input_path = os.path.abspath(input_path)
+    signature = input_path
+    try:
+        stat = os.stat(input_path)
+        signature += '\n%d\n%d' % (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        pass  # fails when it is processed
+    digest = hashlib.sha1(signature.encode()).hexdigest()[:12]
+    name = os.path.basename(os.path.dirname(input_path))
+    return '%s-%s' % (''.join(c if c.isalnum() or c in '-_.' else '_' for c in name), digest)
+
+
+def _worker_id():
+    return '%s.%d' % (socket.gethostname(), os.getpid())
+
+
+class Lease(object):
+    """ A claimed subject, kept alive by a heartbeat thread until finished. """
+
+    def __init__(self, queue, input_path, path):
+        self.queue = queue
+        self.input_path = input_path
+        self.path = path
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.queue.heartbeat):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                return  # reclaimed by another worker, the result is still recorded
+
+    def finish(self, result):
+        """ Write the marker of the result (see batch.strip_subject) and
+        release the lease. """
+
+        self._stop.set()
+        self._heartbeat.join()
+        self.queue.record(self.input_path, result)
+
+
+class LeaseQueue(object):
+    """ Claims subjects through lease files in a shared folder (see the
+    module docstring).
+
+    Parameters
+    ----------
+    queue_dir : str
+        folder shared by all workers, created if it doesn't exist
+    expiry : float
+        seconds after the last heartbeat at which a lease is reclaimed
+    heartbeat : float
+        seconds between two heartbeats, well below expiry
+    """
+
+    def __init__(self, queue_dir, expiry=LEASE_EXPIRY, heartbeat=HEARTBEAT_INTERVAL):
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.expiry = expiry
+        self.heartbeat = heartbeat
+        if not os.path.isdir(self.queue_dir):
+            try:
+                os.makedirs(self.queue_dir)
+            except OSError:
+                if not os.path.isdir(self.queue_dir):  # not created by another worker
+                    raise
+
+    def lease_path(self, input_path):
+        return os.path.join(self.queue_dir, subject_key(input_path) + '.lease')
+
+    def marker_path(self, input_path, marker):
+        return os.path.join(self.queue_dir, subject_key(input_path) + '.' + marker)
+
+    def state(self, input_path):
+        """ 'done', 'failed', 'leased' (possibly expired) or 'pending'. """
+
+        for marker in MARKERS:
+            if os.path.exists(self.marker_path(input_path, marker)):
+                return marker
+        if os.path.exists(self.lease_path(input_path)):
+            return 'leased'
+        return 'pending'
+
+    def record(self, input_path, result):
+        """ Write the marker of the result of a subject (see
+        batch.strip_subject) and remove its lease. """
+
+        marker = self.marker_path(input_path, 'done' if result['success'] else 'failed')
+        tmp_path = '%s.tmp.%s' % (marker, _worker_id())
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(result, worker=_worker_id()), f, indent=2)
+        os.replace(tmp_path, marker)
+        try:
+            os.remove(self.lease_path(input_path))
+        except OSError:
+            pass
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.expiry
+        except OSError:
+            return False
+
+    def _reclaim(self, path):
+        """ Remove an expired lease, True unless another worker was first
+        or its owner is alive after all. """
+
+        stale_path = '%s.stale.%s' % (path, _worker_id())
+        try:
+            os.rename(path, stale_path)
+        except OSError:
+            return False  # reclaimed by another worker
+        if not self._expired(stale_path):
+            # the owner touched it just before the rename: give it back unless it was claimed anew
+            try:
+                os.link(stale_path, path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def claim(self, input_path):
+        """ Lease of the subject, or None if it is finished or leased by
+        a live worker. """
+
+        if self.state(input_path) in MARKERS:
+            return None
+        path = self.lease_path(input_path)
+        info = json.dumps({'input': os.path.abspath(input_path), 'worker': _worker_id(), 'claimed': time.time()})
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except OSError:
+                if not (self._expired(path) and self._reclaim(path)):
+                    return None
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(info)
+            # finished by a worker whose lease was removed after the first check
+            if self.state(input_path) in MARKERS:
+                os.remove(path)
+                return None
+            return Lease(self, input_path, path)
+        return None
+
+
+def _strip_leased(job):
+    """ Claim a subject and skull strip it; None if it was not claimed. """
+
+    queue_args, task = job
+    lease = LeaseQueue(*queue_args).claim(task[0])
+    if lease is None:
+        return None
+    result = batch.strip_subject(task)
+    lease.finish(result)
+    return result
+
+
+def run_queue(inputs, queue_dir, output_root=None, jobs=1, threads=None, companions=None, on_result=None,
+              expiry=LEASE_EXPIRY, heartbeat=HEARTBEAT_INTERVAL, poll=POLL_INTERVAL, **options):
+    """ Skull strip the subjects of the queue that no other worker claims,
+    with `jobs` worker processes, until every subject is finished. Returns
+    the results of the subjects processed here, see batch.run_batch for
+    the other arguments.
+
+    Parameters
+    ----------
+    queue_dir : str
+        folder shared by all workers
+    expiry, heartbeat : float
+        see LeaseQueue
+    poll : float
+        seconds between two passes over subjects leased by other workers
+    """
+
+    queue = LeaseQueue(queue_dir, expiry, heartbeat)
+    threads = batch.thread_budget(jobs, threads)
+    print("Queue %s: %d subjects, %d at a time with %d threads each \n" % (queue.queue_dir, len(inputs), jobs, threads))
+
+    def lost(job):
+        # the worker died with the lease of the subject: mark it as failed for all workers
+        result = batch.lost_subject(job[1])
+        queue.record(result['input'], result)
+        return result
+
+    tasks = batch.make_tasks(inputs, output_root, companions, options)
+    results = []
+    while True:
+        jobs_left = [((queue_dir, expiry, heartbeat), task) for task in tasks
+                     if queue.state(task[0]) not in MARKERS]
+        if not jobs_left:
+            break
+        claimed = 0
+        for result in batch.imap_guarded(_strip_leased, jobs_left, jobs, threads, lost):
+            if result is None:
+                continue
+            claimed += 1
+            status = 'done' if result['success'] else 'FAILED'
+            print("[%d] %s: %s (%.1f min)" % (len(results) + 1, status, result['input'], result['minutes']))
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+        if claimed == 0:
+            # the remaining subjects are leased by other workers: wait for them to finish or expire
+            time.sleep(poll)
+
+    print("%d subjects processed here, %d by other workers \n" % (len(results), len(tasks) - len(results)))
+    return results
@@ -0,0 +1,151 @@
+"""
+Voxel operations on brain masks and tissue maps.
+
+The routines work in float32 and in place where possible, so that the
+mask fusion needs only a few volumes of memory.
+"""
+from __future__ import division
+import numpy as np
+
+# Voxels processed at once when accumulating statistics
+CHUNK_SIZE = 2 ** 20
+
+
+def threshold(data, value, out=None):
+    """ Binary mask (uint8) of the voxels above value.
+
+    Parameters
+    ----------
+    data : array
+        image data, e.g. a registered probability map
+    value : float
+        threshold
+    out : array
+        buffer for the result, allocated as uint8 if None
+    """
+
+    if out is None:
+        out = np.empty(data.shape, dtype=np.uint8)
+    np.greater(data, value, out=out, casting='unsafe')
+
+    return out
+
+
+def normalize(data, out=None):
+    """ Min-max normalization of the data to [0, 1], in float32 (all
+    zeros if the data is constant). """
+
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    low = data.min()
+    high = data.max()
+    np.subtract(data, low, out=out, casting='unsafe')
+    if high > low:
+        np.multiply(out, 1. / (high - low), out=out, casting='unsafe')
+
+    return out
+
+
+def fuse_tissues(tissues, basic_mask, out=None):
+    """ Soft brain mask: sum of the tissue probability maps, restricted to
+    the basic mask.
+
+    Parameters
+    ----------
+    tissues : list of arrays
+        tissue probability maps (e.g. wm, gm, csf) of identical shape
+    basic_mask : array
+        binary mask of the same shape
+    out : array
+        float32 buffer for the result, allocated if None
+    """
+
+    if out is None:
+        out = np.empty(tissues[0].shape, dtype=np.float32)
+    np.copyto(out, tissues[0], casting='unsafe')
+    for tissue in tissues[1:]:
+        np.add(out, tissue, out=out, casting='unsafe')
+    np.multiply(out, basic_mask, out=out, casting='unsafe')
+
+    return out
+
+
+def nonzero_mean_std(data):
+    """ Mean and standard deviation of the nonzero voxels, in a single
+    chunked pass without copying the volume. """
+
+    flat = data.reshape(-1)
+    count = 0
+    total = 0.
+    total_sq = 0.
+    for start in range(0, flat.size, CHUNK_SIZE):
+        chunk = flat[start:start + CHUNK_SIZE].astype(np.float64)
+        count += np.count_nonzero(chunk)
+        total += chunk.sum()
+        total_sq += np.dot(chunk, chunk)
+
+    if count == 0:
+        raise ValueError('The soft mask is empty')
+    mean = total / count
+    std = np.sqrt(max(total_sq / count - mean ** 2, 0.))
+
+    return mean, std
+
+
+def refine_mask(soft_mask, n_sigma=3.0, out=None):
+    """ Refined brain mask: the soft mask without its low outliers, i.e.
+    values below mean - n_sigma * std of the nonzero voxels.
+
+    Parameters
+    ----------
+    soft_mask : array
+        soft brain mask, see fuse_tissues
+    n_sigma : float
+        lower bound in standard deviations below the mean
+    out : array
+        buffer for the binary result (e.g. soft_mask itself, to work in
+        place), allocated as uint8 if None
+    """
+
+    mean, std = nonzero_mean_std(soft_mask)
+    lower_bound = mean - n_sigma * std
+
+    if out is None:
+        out = np.empty(soft_mask.shape, dtype=np.uint8)
+    np.greater_equal(soft_mask, lower_bound, out=out, casting='unsafe')
+
+    return out
+
+
+def sweep_cutoffs(soft_mask, n_sigmas=(), percentiles=()):
+    """ Lower bounds and voxel counts of the refined masks (see
+    refine_mask) of many cutoffs, from a single sort of the soft mask.
+
+    Parameters
+    ----------
+    soft_mask : array
+        soft brain mask, see fuse_tissues
+    n_sigmas : list of float
+        cutoffs in standard deviations below the mean of the nonzero voxels
+    percentiles : list of float
+        cutoffs as percentiles (0 - 100) of the nonzero voxels
+
+    Returns
+    -------
+    bounds : array
+        lower bound of every cutoff, the sigma cutoffs first
+    counts : array
+        number of voxels of the refined mask of every cutoff
+    """
+
+    flat = soft_mask.reshape(-1)
+    values = np.sort(flat[flat != 0])
+    mean, std = nonzero_mean_std(soft_mask)
+    bounds = np.concatenate([mean - np.asarray(n_sigmas, dtype=np.float64) * std,
+                             np.percentile(values, np.asarray(percentiles, dtype=np.float64))])
+
+    # compared in the data type of the soft mask, like refine_mask does
+    counts = values.size - np.searchsorted(values, bounds.astype(values.dtype), side='left')
+    counts += np.where(bounds <= 0, flat.size - values.size, 0)
+
+    return bounds, counts
@@ -0,0 +1,102 @@
+"""
+Moment-based initial alignment of the atlas to the input.
+
+The initial registration searches the pose of the atlas from scratch: ANTs
+from the centers of mass, with a translation stage and up to 10000
+iterations at its coarsest level, reg_aladin from the image centers. On
+scans in an unusual orientation this search is slow and can end in a
+wrong pose. This module computes a rigid starting pose in a fraction of a
+second, from the image moments of both heads:
+
+    - the centers of mass of the head voxels are matched, and
+    - the principal axes of their second moments are aligned.
+
+The principal axes fix the rotation up to the signs of the axes, and
+are ill-defined for an almost spherical head. The four rotations of the
+sign choices, and the plain matching of the centers, are therefore
+scored by the correlation of the two images inside the head of the input,
+and the best one is kept. The moments and the scores are computed on
+copies of the images at about COARSE_VOXEL_SIZE.
+
+Usage:
+    world = moment_alignment(nib.load('t1.nii.gz'), nib.load('atlas_t1.nii'))
+    transforms.write_itk_affine(world, 'init.mat')       # antsRegistration -r
+    transforms.write_niftyreg_affine(world, 'init.txt')  # reg_aladin -inaff
+"""
+from __future__ import division
+import numpy as np
+from scipy import ndimage
+from . import roi
+
+# Voxel size (mm) of the copies the moments and scores are computed on
+COARSE_VOXEL_SIZE = 4.
+# Sign choices of the principal axes that keep a rotation proper
+AXIS_SIGNS = [(1, 1, 1), (1, -1, -1), (-1, 1, -1), (-1, -1, 1)]
+
+
+def _coarse(img):
+    """ Strided copy of an image at about COARSE_VOXEL_SIZE, and its affine. """
+
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    steps = np.maximum(np.round(COARSE_VOXEL_SIZE / zooms).astype(int), 1)
+    data = np.asanyarray(img.dataobj[::steps[0], ::steps[1], ::steps[2]])
+    data = data.reshape(data.shape[:3]).astype(np.float32)
+    return data, img.affine.dot(np.diag(list(steps) + [1]))
+
+
+def head_moments(data, affine):
+    """ Center (mm) and covariance (mm^2) of the head voxels in world
+    coordinates, and the head voxels, see roi.head_bounding_box. """
+
+    head = data > roi.HEAD_THRESHOLD * np.percentile(data, 99)
+    points = affine[:3, :3].dot(np.array(np.nonzero(head), dtype=np.float64)) + affine[:3, 3:]
+    return points.mean(axis=1), np.cov(points), head
+
+
+def _correlation(fixed, fixed_affine, head, moving, moving_affine, world):
+    """ Correlation of the fixed image and the moving image mapped by world,
+    over the head voxels of the fixed image. """
+
+    voxel_map = np.linalg.inv(moving_affine).dot(world).dot(fixed_affine)
+    voxels = np.array(np.nonzero(head), dtype=np.float64)
+    sampled = ndimage.map_coordinates(moving, voxel_map[:3, :3].dot(voxels) + voxel_map[:3, 3:], order=1)
+    if sampled.std() == 0:
+        return -1.
+    return float(np.corrcoef(fixed[head], sampled)[0, 1])
+
+
+def moment_alignment(fixed_img, moving_img):
+    """ Rigid world (RAS) transformation from fixed to moving space that
+    matches the centers of mass and the principal axes of the heads (see
+    the module docstring), in the convention of transforms.py.
+
+    Parameters
+    ----------
+    fixed_img : nibabel image
+        the reference image, e.g. the input scan
+    moving_img : nibabel image
+        the image registered to it, e.g. the atlas T1
+    """
+
+    fixed, fixed_affine = _coarse(fixed_img)
+    moving, moving_affine = _coarse(moving_img)
+    fixed_center, fixed_covariance, head = head_moments(fixed, fixed_affine)
+    moving_center, moving_covariance, _ = head_moments(moving, moving_affine)
+
+    # principal axes as columns, ordered by their extent
+    fixed_axes = np.linalg.eigh(fixed_covariance)[1]
+    moving_axes = np.linalg.eigh(moving_covariance)[1]
+    flip = np.sign(np.linalg.det(fixed_axes) * np.linalg.det(moving_axes))
+    rotations = [np.eye(3)] + [moving_axes.dot(np.diag(flip * np.array(signs))).dot(fixed_axes.T)
+                               for signs in AXIS_SIGNS]
+
+    best = None
+    for rotation in rotations:
+        world = np.eye(4)
+        world[:3, :3] = rotation
+        world[:3, 3] = moving_center - rotation.dot(fixed_center)
+        score = _correlation(fixed, fixed_affine, head, moving, moving_affine, world)
+        if best is None or score > best[0]:
+            best = (score, world)
+
+    return best[1]
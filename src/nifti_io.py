@@ -0,0 +1,164 @@
+"""
+Memory-lean nifti I/O.
+
+Images are opened lazily: uncompressed files are memory-mapped and only
+the slabs of slices that are processed are read. Results are streamed
+slab by slab to the output file, so the memory use is bounded by the
+slab size rather than by the size of the image.
+
+Outputs are written with compact encodings: binary masks as uint8, and
+probability maps quantized to uint8 or uint16 with a scl_slope (see
+quantize). The zlib compression level is selectable, level 0 meaning
+uncompressed .nii files.
+
+Usage:
+    apply_mask_streaming('t1.nii.gz', nib.load('mask.nii.gz'), 't1_masked.nii.gz')
+    data, slope = quantize(probabilities, np.uint8)
+    save(nib.Nifti1Image(data, affine), 'gm.nii.gz', slope=slope, compresslevel=1)
+"""
+from __future__ import division
+import gzip
+import numpy as np
+import nibabel as nib
+
+# Number of slices (along the last spatial axis) processed at once
+SLAB_SIZE = 16
+# zlib compression level of .nii.gz outputs
+COMPRESS_LEVEL = 6
+# Data types of stored probability maps, the integer types are quantized
+PROBABILITY_TYPES = {'uint8': np.uint8, 'uint16': np.uint16, 'float32': np.float32}
+
+
+def load(path):
+    """ Load a nifti image lazily. The voxel data stays on disk (memory
+    mapped if uncompressed) until it is sliced; compressed files are kept
+    open so that consecutive slabs don't decompress from the start. """
+
+    return nib.load(path, mmap=True, keep_file_open=True)
+
+
+def open_output(path, compresslevel=COMPRESS_LEVEL):
+    """ Open a file for writing, gzip compressed if path ends with .gz """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wb', compresslevel=compresslevel)
+    return open(path, 'wb')
+
+
+def write_header(fileobj, header):
+    """ Write a single file nifti header and pad up to the voxel data. """
+
+    header.write_to(fileobj)
+    padding = int(header.get_data_offset()) - fileobj.tell()
+    fileobj.write(b'\x00' * padding)
+
+
+def extension(compresslevel=COMPRESS_LEVEL):
+    """ File extension of nifti outputs: .nii if uncompressed (level 0). """
+
+    return '.nii.gz' if compresslevel > 0 else '.nii'
+
+
+def quantize(data, dtype=np.uint8):
+    """ Probabilities (clipped to [0, 1]) as integers of dtype, and the
+    scl_slope turning them back into probabilities. A float dtype is
+    kept as it is, with slope 1. """
+
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.asarray(data, dtype=dtype), 1.
+    top = np.iinfo(dtype).max
+    quantized = np.clip(data, 0, 1) * top
+    return np.round(quantized, out=quantized).astype(dtype), 1. / top
+
+
+def save(img, path, slope=1., compresslevel=COMPRESS_LEVEL, slab_size=SLAB_SIZE):
+    """ Write an image to a single file nifti, streamed slab by slab.
+
+    Parameters
+    ----------
+    img : nibabel image
+        the voxel values are stored as they are, in their data type
+        (e.g. uint8 for masks, see quantize for probabilities)
+    path : str
+        .nii or .nii.gz path
+    slope : float
+        scl_slope of the stored values
+    compresslevel : int
+        zlib compression level for .nii.gz paths
+    slab_size : int
+        number of slices written at once
+    """
+
+    data = np.asanyarray(img.dataobj)
+    header = nib.Nifti1Header.from_header(img.header)
+    header['vox_offset'] = 0
+    header.set_data_dtype(data.dtype)
+    header.set_data_shape(data.shape)
+    header.set_slope_inter(slope, 0)
+
+    with open_output(path, compresslevel) as f:
+        write_header(f, header)
+        for start in range(0, data.shape[2], slab_size):
+            f.write(data[:, :, start:start + slab_size].tobytes(order='F'))
+
+    return path
+
+
+def _has_scaling(img):
+    # the scaling of a loaded image is kept by its array proxy
+    slope = getattr(img.dataobj, 'slope', 1.)
+    inter = getattr(img.dataobj, 'inter', 0.)
+    return not (slope == 1 and inter == 0)
+
+
+def apply_mask_streaming(image_path, mask, output_path, slab_size=SLAB_SIZE, compresslevel=COMPRESS_LEVEL):
+    """ Multiply an image with a mask slab by slab and stream the result to
+    a nifti file.
+
+    Parameters
+    ----------
+    image_path : str
+        .nii or .nii.gz path of the image, 3D, or 4D (the mask is applied
+        to every volume, a singleton 4th dimension is removed)
+    mask : nibabel image
+        mask with the spatial shape of the image (may be a lazy image)
+    output_path : str
+        .nii or .nii.gz path of the result
+    slab_size : int
+        number of slices processed at once
+    compresslevel : int
+        zlib compression level for .nii.gz outputs
+    """
+
+    img = load(image_path)
+    shape = img.shape
+    if len(shape) == 4 and shape[3] == 1:
+        shape = shape[:3]
+    n_volumes = shape[3] if len(shape) == 4 else 1
+    if mask.shape[:3] != shape[:3]:
+        raise ValueError('Mask and image %s have different shapes' % image_path)
+
+    header = nib.Nifti1Header.from_header(img.header)
+    header['vox_offset'] = 0
+    header.set_data_shape(shape)
+    # the raw voxel values can be masked as they are, unless they are scaled
+    if _has_scaling(img):
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+    dtype = header.get_data_dtype()
+
+    with open_output(output_path, compresslevel) as f:
+        write_header(f, header)
+        # nifti data is stored in fortran order: the last axis varies slowest
+        for volume in range(n_volumes):
+            for start in range(0, shape[2], slab_size):
+                stop = min(start + slab_size, shape[2])
+                if len(img.shape) == 4:
+                    slab = img.dataobj[:, :, start:stop, volume]
+                else:
+                    slab = img.dataobj[:, :, start:stop]
+                masked = np.multiply(slab, mask.dataobj[:, :, start:stop])
+                f.write(masked.astype(dtype).tobytes(order='F'))
+
+    return output_path
@@ -19,25 +19,9 @@ csf = TISSUES[CSF]
 
 # paths
 registration_dir = '/usr/local/lib/nifty_reg-1.3.9/nifty_reg/build/reg-apps/'
-atlas_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                         'atlas_sri24_spm8')
-
-# atlas paths
-ATLAS_SPM = {}
-# add atlas tissues
-atlas_spm_tissues = os.path.join(atlas_dir, 'apriori')
-for tissue in TISSUES:
-    ATLAS_SPM[tissue] = {}
-    ATLAS_SPM[tissue]['high_uint8'] = \
-        os.path.join(atlas_spm_tissues, '%s_high.nii.gz' % tissue)
-# add atlas modalities
-atlas_spm_mod = os.path.join(atlas_dir, 'templates')
-ATLAS_SPM['t1'] = os.path.join(atlas_spm_mod, 'T1.gz.nii')
-ATLAS_SPM['t1_masked'] = os.path.join(atlas_spm_mod, 'T1_brain.nii.gz')
-ATLAS_SPM['t2'] = os.path.join(atlas_spm_mod, 'T2.gz.nii')
-ATLAS_SPM['t2_masked'] = os.path.join(atlas_spm_mod, 'T2_brain.nii.gz')
-ATLAS_SPM['pd'] = os.path.join(atlas_spm_mod, 'PD.gz.nii')
-ATLAS_SPM['pd_masked'] = os.path.join(atlas_spm_mod, 'PD_brain.nii.gz')
+# atlas nifti files (see skull.ATLAS_FILES) and their pack (see atlas.py)
+ATLAS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Atlas')
+ATLAS_PACK = os.path.join(ATLAS_DIR, 'atlas.s3pack')
 
 # example path
 T1_EXAMPLE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
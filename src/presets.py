@@ -0,0 +1,60 @@
+"""
+Speed/accuracy presets of the registrations.
+
+    default  : registrations at the input resolution, as published
+    fast     : registrations on a copy of the input cropped to the head and
+               downsampled to 2 mm, with fewer iterations. The transformations
+               are applied at the input resolution.
+    accurate : more iterations and registration levels at the input resolution
+
+Every preset holds:
+    voxel_size        : voxel size (mm) of the images registered, None for the
+                        input resolution
+    initializer       : starting pose of the initial registration: 'moments'
+                        (see moments.py) or 'center' (the centers of mass for
+                        ANTs, the image centers for reg_aladin)
+    ants_iterations   : iterations per level of the ANTs affine stage
+    ants_moment_iterations : the same, when initialized by moments; the
+                        translation stage is skipped then
+    syn_iterations    : iterations per level of the ANTs deformable (SyN) stage
+    aladin_params     : additional reg_aladin parameters
+    f3d_params        : additional reg_f3d parameters
+"""
+
+PRESETS = {
+    'fast': {
+        'voxel_size': 2.0,
+        'initializer': 'moments',
+        'ants_iterations': '1000x200x50',
+        'ants_moment_iterations': '500x200x50',
+        'syn_iterations': '40x20x0',
+        'aladin_params': ['-ln', '2'],
+        'f3d_params': ['-ln', '2', '-maxit', '150'],
+    },
+    'default': {
+        'voxel_size': None,
+        'initializer': 'moments',
+        'ants_iterations': '10000x1111x5',
+        'ants_moment_iterations': '1000x500x5',
+        'syn_iterations': '100x70x20',
+        'aladin_params': [],
+        'f3d_params': [],
+    },
+    'accurate': {
+        'voxel_size': None,
+        'initializer': 'moments',
+        'ants_iterations': '10000x1111x100',
+        'ants_moment_iterations': '2000x1111x100',
+        'syn_iterations': '100x100x50',
+        'aladin_params': ['-ln', '4'],
+        'f3d_params': ['-ln', '4', '-maxit', '500'],
+    },
+}
+
+
+def get_preset(name):
+    """ Parameters of the preset `name` (fast, default or accurate). """
+
+    if name not in PRESETS:
+        raise ValueError('Unknown preset %s, choose one of %s' % (name, ', '.join(sorted(PRESETS))))
+    return PRESETS[name]
@@ -0,0 +1,216 @@
+"""
+Per-stage timing and resource usage of skull stripping runs.
+
+For every stage the report records the wall time, the CPU time of this
+process and of the registration tools it ran, the peak resident memory
+of this process and of the largest registration tool during the stage,
+and the bytes read and written (including the registration tools, on
+Linux). Reports are saved as json next to the outputs and can be
+aggregated over a cohort.
+
+ru_maxrss is the peak of the whole life of a process, and the workers of
+a batch process many subjects. The peak of this process is therefore
+reset at the start of every stage through /proc/self/clear_refs and read
+from VmHWM (Linux only, None elsewhere), and the peak of every
+registration tool is taken from its own resource usage (see record_tool).
+
+Usage:
+    report = RunReport(input=input_path)
+    with report.stage('rigid'):
+        ...
+    report.save('t1_s3_report.json')
+"""
+from __future__ import division
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+IO_COUNTERS = '/proc/self/io'
+CLEAR_REFS = '/proc/self/clear_refs'
+PROCESS_STATUS = '/proc/self/status'
+
+# Peak resident memory (MB) of every registration tool that finished, see record_tool
+_tool_peaks = []
+
+
+def _rss_mb(maxrss):
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    if sys.platform == 'darwin':
+        return maxrss / 1024. ** 2
+    return maxrss / 1024.
+
+
+def record_tool(rusage):
+    """ Record the resource usage of a finished registration tool (as
+    returned by os.wait4), for the peak memory of the stage it ran in. """
+
+    _tool_peaks.append(_rss_mb(rusage.ru_maxrss))
+
+
+def _reset_peak():
+    """ Reset the peak resident memory of this process, False if that is
+    not supported. """
+
+    try:
+        with open(CLEAR_REFS, 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _peak_rss_mb():
+    """ Peak resident memory of this process since the last reset (Linux
+    only, None elsewhere). """
+
+    try:
+        with open(PROCESS_STATUS) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _io_counters():
+    """ Bytes read and written by this process and its waited-for children
+    (Linux only, None elsewhere). """
+
+    if not os.path.exists(IO_COUNTERS):
+        return None
+    counters = {}
+    with open(IO_COUNTERS) as f:
+        for line in f:
+            key, value = line.split(':')
+            counters[key] = int(value)
+    return counters
+
+
+def _snapshot():
+    return {'time': time.time(),
+            'self': resource.getrusage(resource.RUSAGE_SELF),
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN),
+            'tools': len(_tool_peaks),
+            'io': _io_counters()}
+
+
+def _difference(before, after):
+    """ Resource usage between two snapshots. """
+
+    usage = {
+        'wall_time': after['time'] - before['time'],
+        'cpu_time': (after['self'].ru_utime + after['self'].ru_stime) -
+                    (before['self'].ru_utime + before['self'].ru_stime),
+        'children_cpu_time': (after['children'].ru_utime + after['children'].ru_stime) -
+                             (before['children'].ru_utime + before['children'].ru_stime),
+        'peak_rss_mb': None,
+        # the largest registration tool that ran in between
+        'children_peak_rss_mb': max(_tool_peaks[before['tools']:after['tools']] or [None]),
+        'bytes_read': None,
+        'bytes_written': None,
+    }
+    if before['io'] is not None and after['io'] is not None:
+        usage['bytes_read'] = after['io']['rchar'] - before['io']['rchar']
+        usage['bytes_written'] = after['io']['wchar'] - before['io']['wchar']
+
+    return usage
+
+
+class RunReport(object):
+    """ Resource usage of the stages of one run.
+
+    Parameters
+    ----------
+    info :
+        keyword arguments describing the run (input, options), stored
+        with the report
+    """
+
+    def __init__(self, **info):
+        self.info = info
+        self.stages = []
+        self.error = None
+        self._start = _snapshot()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Measure the stage run inside the with block. """
+
+        before = _snapshot()
+        reset = _reset_peak()
+        try:
+            yield
+        finally:
+            usage = _difference(before, _snapshot())
+            if reset:
+                usage['peak_rss_mb'] = _peak_rss_mb()
+            usage['stage'] = name
+            self.stages.append(usage)
+
+    def skip(self, name):
+        """ Record a stage that did not need to run (resumed or cached). """
+
+        self.stages.append({'stage': name, 'skipped': True})
+
+    def to_dict(self):
+        report = dict(self.info)
+        report['stages'] = self.stages
+        report['total'] = _difference(self._start, _snapshot())
+        # the peak is reset by every stage
+        peaks = [usage['peak_rss_mb'] for usage in self.stages if usage.get('peak_rss_mb') is not None]
+        report['total']['peak_rss_mb'] = max(peaks) if peaks else None
+        report['error'] = self.error
+        return report
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def aggregate(reports):
+    """ Per-stage totals, means and maxima of the stages that ran, over the
+    reports (dictionaries, see RunReport.to_dict) of a cohort. """
+
+    stages = {}
+    order = []
+    for report in reports:
+        for usage in report['stages']:
+            if usage.get('skipped'):
+                continue
+            name = usage['stage']
+            if name not in stages:
+                stages[name] = []
+                order.append(name)
+            stages[name].append(usage)
+
+    summary = []
+    for name in order:
+        runs = stages[name]
+        entry = {'stage': name, 'runs': len(runs)}
+        for key in ['wall_time', 'cpu_time', 'children_cpu_time', 'bytes_read', 'bytes_written']:
+            values = [usage[key] for usage in runs if usage[key] is not None]
+            if values:
+                entry[key + '_total'] = sum(values)
+                entry[key + '_mean'] = sum(values) / len(values)
+                entry[key + '_max'] = max(values)
+        for key in ['peak_rss_mb', 'children_peak_rss_mb']:
+            values = [usage[key] for usage in runs if usage[key] is not None]
+            entry[key + '_max'] = max(values) if values else None
+        summary.append(entry)
+
+    return {'subjects': len(reports),
+            'failed': sum(1 for report in reports if report.get('error')),
+            'stages': summary}
+
+
+def print_aggregate(summary):
+    """ Print the mean wall and CPU time of every stage. """
+
+    print("%-12s %6s %12s %16s" % ('stage', 'runs', 'wall (s)', 'tools cpu (s)'))
+    for entry in summary['stages']:
+        print("%-12s %6d %12.1f %16.1f" % (entry['stage'], entry['runs'], entry.get('wall_time_mean', 0),
+                                           entry.get('children_cpu_time_mean', 0)))
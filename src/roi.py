@@ -0,0 +1,83 @@
+"""
+Regions of interest and resolution changes of nifti images.
+
+Cropping and resampling keep the images in the same physical space: the
+affine of the result is adjusted, so transformations computed on the
+cropped or downsampled image apply to the original one.
+"""
+from __future__ import division
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+# Voxels brighter than this fraction of the 99th intensity percentile are head
+HEAD_THRESHOLD = 0.05
+
+
+def bounding_box(data, pad=0):
+    """ Bounding box (list of slices) of the nonzero voxels of a 3D array,
+    grown by pad voxels on every side and clipped to the array. """
+
+    nonzero = np.nonzero(data)
+    if len(nonzero[0]) == 0:
+        return [slice(0, size) for size in data.shape[:3]]
+    return [slice(max(int(index.min()) - pad, 0), min(int(index.max()) + pad + 1, size))
+            for index, size in zip(nonzero, data.shape[:3])]
+
+
+def head_bounding_box(img, pad=4):
+    """ Bounding box of the head (the voxels brighter than HEAD_THRESHOLD
+    of the 99th percentile) of an image. """
+
+    data = np.asanyarray(img.dataobj)
+    data = data.reshape(data.shape[:3])
+    threshold = HEAD_THRESHOLD * np.percentile(data, 99)
+    return bounding_box(data > threshold, pad)
+
+
+def crop(img, box):
+    """ Crop an image to a bounding box, keeping its position in space. """
+
+    data = np.asanyarray(img.dataobj)
+    data = data.reshape(data.shape[:3])[tuple(box)]
+    start = [index.start for index in box]
+    affine = img.affine.dot(nib.affines.from_matvec(np.eye(3), start))
+
+    header = img.header.copy()
+    return nib.Nifti1Image(data, affine, header)
+
+
+def paste(img, reference, box, dtype=None):
+    """ Inverse of crop: place an image cropped from reference to box back
+    into the grid of reference, the voxels outside the box are zero. """
+
+    start = [index.start for index in box]
+    if not np.allclose(img.affine, reference.affine.dot(nib.affines.from_matvec(np.eye(3), start)), atol=1e-4):
+        raise ValueError('The image is not cropped to the box of the reference grid')
+
+    data = np.asanyarray(img.dataobj)
+    data = data.reshape(data.shape[:3])
+    full = np.zeros(reference.shape[:3], dtype=dtype or data.dtype)
+    full[tuple(box)] = data
+    header = img.header.copy()
+    return nib.Nifti1Image(full, reference.affine, header)
+
+
+def downsample(img, voxel_size):
+    """ Resample an image to a coarser voxel size (mm) along its voxel
+    axes. Axes that are already coarser are left unchanged. """
+
+    data = np.asanyarray(img.dataobj).astype(np.float32)
+    data = data.reshape(data.shape[:3])
+    factors = np.maximum(voxel_size / np.array(img.header.get_zooms()[:3], dtype=float), 1.)
+    if np.all(factors == 1):
+        return nib.Nifti1Image(data, img.affine)
+
+    # smooth to avoid aliasing, then sample at the centers of the coarse voxels
+    data = ndimage.gaussian_filter(data, sigma=(factors - 1) / 2.)
+    offset = (factors - 1) / 2.
+    shape = np.ceil(np.array(data.shape) / factors).astype(int)
+    low_res = ndimage.affine_transform(data, np.diag(factors), offset=offset, output_shape=tuple(shape), order=1)
+    affine = img.affine.dot(nib.affines.from_matvec(np.diag(factors), offset))
+
+    return nib.Nifti1Image(low_res, affine)
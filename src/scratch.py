@@ -0,0 +1,84 @@
+"""
+Per-run scratch workspace.
+
+Every skull stripping run gets its own temporary folder for intermediate
+files (registration results, transformations, control point grids), so
+that concurrent runs never overwrite each other's files. The folder is
+removed when the run ends, whether it succeeded or not.
+
+The intermediate files a run needs to resume (see checkpoint.py) are kept
+in a work folder in the same scratch root, named after the input and
+output of the run, so that an interrupted run finds it again.
+
+Usage:
+    with ScratchDir(root='tmpfs') as scratch_dir:
+        aff_path = scratch_dir.path('t1_atlas_aff_transformation.txt')
+    work_dir = get_work_dir('tmpfs', 't1.nii.gz', 'output')
+"""
+import getpass
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Environment variable selecting the scratch root if none is given
+SCRATCH_VARIABLE = 'S3_SCRATCH_DIR'
+TMPFS_DIR = '/dev/shm'
+# Folder of the work folders inside the scratch root, per user
+WORK_FOLDER = 's3_work-%s'
+
+
+def get_scratch_root(root=None):
+    """ Resolve the folder in which scratch folders are created.
+
+    Parameters
+    ----------
+    root : str
+        a folder (e.g. a fast local disk), 'tmpfs' for the shared memory
+        file system, or None for $S3_SCRATCH_DIR, falling back to the
+        system temporary folder ($TMPDIR).
+    """
+
+    if root is None:
+        root = os.environ.get(SCRATCH_VARIABLE)
+    if root == 'tmpfs':
+        root = TMPFS_DIR if os.path.isdir(TMPFS_DIR) else None
+    if root is not None and not os.path.isdir(root):
+        os.makedirs(root)
+
+    return root
+
+
+def get_work_dir(root, input_path, output_path):
+    """ Work folder of the run of input_path into output_path, in the
+    scratch root (see get_scratch_root). The folder is not created. """
+
+    root = get_scratch_root(root) or tempfile.gettempdir()
+    run = '%s\n%s' % (os.path.abspath(input_path), os.path.abspath(output_path))
+    name = os.path.basename(input_path).split('.')[0]
+    return os.path.join(root, WORK_FOLDER % getpass.getuser(),
+                        '%s-%s' % (name, hashlib.sha1(run.encode()).hexdigest()[:12]))
+
+
+class ScratchDir(object):
+    """ Isolated temporary folder, removed on exit. """
+
+    def __init__(self, root=None, prefix='s3_'):
+        self.root = get_scratch_root(root)
+        self.prefix = prefix
+        self.dir = None
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix=self.prefix, dir=self.root)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir = None
+
+    def path(self, file_name):
+        """ Path to file_name inside the scratch folder. """
+
+        if self.dir is None:
+            raise RuntimeError('Scratch folder is only available inside a with block')
+        return os.path.join(self.dir, file_name)
@@ -0,0 +1,248 @@
+"""
+Skull stripping service.
+
+A resident server that accepts skull stripping jobs over a local Unix
+socket. The worker processes are started once: the imports, the atlas
+pack and the registration binaries are loaded when they start, so a job
+only pays for the skull stripping itself. At most `jobs` scans are
+processed at the same time, further jobs wait in a queue.
+
+The protocol is one json object per line in each direction. Requests:
+
+    {"cmd": "submit", "input": path, "output": folder, "options": {...}}
+        queue a job; options are SkullStripper keyword arguments
+        (want_tissues, want_atlas, preset, companion_paths, in_memory,
+        compression, tissue_type, keep_intermediates). The paths are
+        absolute, the service does not share the folder of the client.
+    {"cmd": "status", "job": id}    state of a job
+    {"cmd": "wait", "job": id}      state of a job, once it finished
+    {"cmd": "list"}                 state of all jobs
+    {"cmd": "shutdown"}             stop after the running jobs
+
+Every response holds "ok" and either the requested data or an "error".
+A job is "pending" until it finished, then "done" or "failed"; finished
+jobs carry the result of batch.strip_subject (outputs, error, run report).
+The service remembers the last FINISHED_JOBS finished jobs only.
+
+Usage:
+    python s3.py --serve /tmp/s3.sock --jobs 2
+    python s3.py --submit /tmp/s3.sock -i t1.nii.gz -o output
+"""
+from __future__ import division
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import threading
+from . import batch
+
+# Options of a job that a client may set, the others are set by the server
+JOB_OPTIONS = ['want_tissues', 'want_atlas', 'preset', 'companion_paths', 'in_memory', 'compression',
+               'tissue_type', 'keep_intermediates']
+# Number of finished jobs kept for status requests, older ones are forgotten
+FINISHED_JOBS = 1000
+
+
+def _init_worker(threads, atlas_dir, backend_names):
+    """ Warm up a worker process: imports, atlas pack and binaries. """
+
+    batch.set_thread_count(threads)
+    from . import skull  # noqa: F401
+    from . import atlas
+    from . import backends
+    from . import paths
+
+    pack_path = atlas_dir or paths.ATLAS_PACK
+    if os.path.isdir(pack_path):
+        pack_path = os.path.join(pack_path, os.path.basename(paths.ATLAS_PACK))
+    if os.path.isfile(pack_path):
+        atlas.load_pack(pack_path)
+    for name in backend_names:
+        backends.get_backend(name)
+
+
+class Job(object):
+
+    def __init__(self, job_id, input_path, output_path, options):
+        self.id = job_id
+        self.input_path = input_path
+        self.output_path = output_path
+        self.options = options
+        self.state = 'pending'
+        self.result = None
+        self.finished = threading.Event()
+
+    def to_dict(self):
+        return {'job': self.id, 'input': self.input_path, 'output': self.output_path,
+                'state': self.state, 'result': self.result}
+
+
+class SkullStripService(object):
+    """ Queue of skull stripping jobs run by a pool of warm workers.
+
+    Parameters
+    ----------
+    jobs : int
+        number of scans processed at the same time
+    threads : int
+        threads per scan; by default the cores are divided among jobs
+    defaults :
+        SkullStripper keyword arguments of every job (cache, scratch_root,
+        atlas_dir, backends, ...), job options override them
+    """
+
+    def __init__(self, jobs=1, threads=None, **defaults):
+        self.defaults = defaults
+        self.jobs = {}
+        self._finished = collections.deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        backend_names = [defaults.get('rigid_backend', 'ants'), defaults.get('deformable_backend', 'niftyreg')]
+        self.pool = multiprocessing.Pool(jobs, initializer=_init_worker,
+                                         initargs=(batch.thread_budget(jobs, threads), defaults.get('atlas_dir'),
+                                                   backend_names))
+
+    def submit(self, input_path, output_path=None, options=None):
+        """ Queue a job, returns it. """
+
+        input_path = os.path.abspath(input_path)
+        if not os.path.isfile(input_path):
+            raise ValueError(input_path + ' does not exist')
+        if output_path is None:
+            output_path = batch.get_output_path(input_path)
+        job_options = dict(self.defaults)
+        for key, value in (options or {}).items():
+            if key not in JOB_OPTIONS:
+                raise ValueError('Unknown job option ' + key)
+            job_options[key] = value
+        for path in job_options.get('companion_paths') or []:
+            # relative to the folder of the client, which the service doesn't know
+            if not os.path.isabs(path):
+                raise ValueError('Companion path %s is not absolute' % path)
+
+        with self._lock:
+            job = Job(next(self._ids), input_path, os.path.abspath(output_path), job_options)
+            self.jobs[job.id] = job
+        self.pool.apply_async(batch.strip_subject, ((job.input_path, job.output_path, job.options),),
+                              callback=lambda result: self._finish(job, result),
+                              error_callback=lambda error: self._finish(job, {'success': False, 'error': str(error)}))
+        return job
+
+    def _finish(self, job, result):
+        job.result = result
+        job.state = 'done' if result['success'] else 'failed'
+        job.finished.set()
+        # forget the oldest finished jobs, the service may run for months
+        with self._lock:
+            self._finished.append(job.id)
+            while len(self._finished) > FINISHED_JOBS:
+                self.jobs.pop(self._finished.popleft(), None)
+
+    def handle(self, request):
+        """ Response (dictionary) to a request, see the module docstring. """
+
+        try:
+            cmd = request.get('cmd')
+            if cmd == 'submit':
+                job = self.submit(request['input'], request.get('output'), request.get('options'))
+                return dict(ok=True, **job.to_dict())
+            if cmd in ('status', 'wait'):
+                with self._lock:
+                    job = self.jobs.get(request.get('job'))
+                if job is None:
+                    raise ValueError('Unknown job %s' % request.get('job'))
+                if cmd == 'wait':
+                    job.finished.wait(request.get('timeout'))
+                return dict(ok=True, **job.to_dict())
+            if cmd == 'list':
+                with self._lock:
+                    jobs = list(self.jobs.values())
+                return {'ok': True, 'jobs': [job.to_dict() for job in jobs]}
+            raise ValueError('Unknown command %s' % cmd)
+        except Exception as e:
+            return {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+
+    def close(self):
+        """ Stop accepting jobs and wait for the queued ones. """
+
+        self.pool.close()
+        self.pool.join()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+            except ValueError:
+                response = {'ok': False, 'error': 'Requests are json objects, one per line'}
+            else:
+                if request.get('cmd') == 'shutdown':
+                    # shutdown() waits for serve_forever to return, call it from another thread
+                    threading.Thread(target=self.server.shutdown).start()
+                    response = {'ok': True}
+                else:
+                    response = self.server.service.handle(request)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, jobs=1, threads=None, **defaults):
+    """ Run the service on a Unix socket until it receives a shutdown
+    request, see SkullStripService for the arguments. """
+
+    if os.path.exists(socket_path):
+        try:
+            request(socket_path, {'cmd': 'list'})
+        except (OSError, ValueError):
+            os.remove(socket_path)  # left behind by a service that died
+        else:
+            raise RuntimeError('A service is already running on ' + socket_path)
+
+    service = SkullStripService(jobs, threads, **defaults)
+    server = _Server(socket_path, _Handler)
+    server.service = service
+    os.chmod(socket_path, 0o600)
+    print("Skull stripping service listening on %s with %d workers \n" % (socket_path, jobs))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        service.close()
+
+
+def request(socket_path, message):
+    """ Send a request to the service, returns its response. """
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(message).encode() + b'\n')
+        with client.makefile('rb') as response:
+            return json.loads(response.readline().decode())
+    finally:
+        client.close()
+
+
+def submit(socket_path, input_path, output_path=None, wait=True, **options):
+    """ Submit a scan to the service and, if wait, return the finished job
+    (see the module docstring). Relative paths are taken relative to the
+    current folder. """
+
+    if options.get('companion_paths'):
+        options['companion_paths'] = [os.path.abspath(path) for path in options['companion_paths']]
+    response = request(socket_path, {'cmd': 'submit', 'input': os.path.abspath(input_path),
+                                     'output': os.path.abspath(output_path) if output_path else None,
+                                     'options': options})
+    if not response['ok'] or not wait:
+        return response
+    return request(socket_path, {'cmd': 'wait', 'job': response['job']})
@@ -9,16 +9,42 @@ Usage:
     Run skull stripping method:
     e.g:
         mask_path = skull.stripper.strip_skull(input_path, output_path, want_tissues)
+
+    The method runs as a sequence of stages (see STAGES). Completed stages are
+    recorded in a manifest in the work folder, and an interrupted run resumes
+    from the first incomplete stage.
 """
 from __future__ import division
-import subprocess
-import shlex
 import os
+import shutil
 import numpy as np
 import nibabel as nib
-from nilearn.image import math_img
 from . import helpers as utils
-from . import registration as reg
+from . import backends
+from . import paths
+from . import scratch
+from . import cache as reg_cache
+from . import checkpoint
+from . import masks
+from . import moments
+from . import nifti_io
+from . import presets
+from . import roi
+from . import transforms
+from . import atlas
+from . import profiling
+
+# Atlas files registered to the input
+ATLAS_FILES = ['atlas_t1.nii', 'atlas_mask.nii', 'atlas_wm.nii', 'atlas_gm.nii', 'atlas_csf.nii']
+# Threshold turning the registered atlas mask into the basic mask
+BASIC_MASK_THRESHOLD = 0.9
+# Voxels of the soft mask more than this many standard deviations below its mean are cut from the refined mask
+REFINED_MASK_SIGMAS = 3.0
+# Margin (mm) around the basic mask kept for the registrations of the skull stripped atlas
+BRAIN_CROP_MARGIN = 10.
+TISSUES = ['csf', 'gm', 'wm']
+# Stages of the skull stripping, in order of execution
+STAGES = ['rigid', 'basic-mask', 'masking', 'affine', 'nonrigid', 'resample', 'refine', 'apply']
 
 
 class SkullStripper():
@@ -27,160 +53,473 @@ class SkullStripper():
     # @param input_path : Path to the input modality to skull strip
     # @param output_path : Path the to output folder.
     # @param want_tissue: Boolean for outputting the tissue registrations
-    def __init__(self, input_path, output_path, want_tissues, want_atlas):
+    # @param want_atlas: Boolean for outputting the atlas registered to the input
+    # @param scratch_root: Folder (or 'tmpfs') for the per-run intermediate files
+    # @param cache: RegistrationCache to reuse registrations of earlier runs, None to disable caching
+    # @param in_memory: Keep intermediate images in memory and write only the final outputs
+    # @param companion_paths: Paths to further modalities of the subject, co-registered with the input,
+    #                         to which the brain mask of the input is applied as well
+    # @param preset: Speed/accuracy preset of the registrations: 'fast', 'default' or 'accurate'
+    # @param atlas_dir: Folder with the atlas files (see ATLAS_FILES) or an atlas pack (see atlas.py), src/Atlas
+    #                   by default. The pack is used if the folder holds one.
+    # @param rigid_backend: Registration package of the initial affine registration: 'ants' or 'niftyreg'
+    # @param deformable_backend: Registration package of the affine and deformable registrations of the
+    #                            skull stripped atlas: 'niftyreg' or 'ants'
+    # @param compression: zlib compression level of the nifti outputs, 0 for uncompressed .nii files
+    # @param tissue_type: Data type of the saved tissue maps: 'uint8' or 'uint16' (quantized probabilities,
+    #                     see nifti_io.quantize) or 'float32'
+    # @param keep_intermediates: Save the intermediate outputs (soft mask, scan masked with the basic mask,
+    #                            registered basic mask)
+    def __init__(self, input_path, output_path, want_tissues, want_atlas, scratch_root=None, cache=None,
+                 in_memory=False, companion_paths=None, preset='default', atlas_dir=None,
+                 rigid_backend='ants', deformable_backend='niftyreg', compression=nifti_io.COMPRESS_LEVEL,
+                 tissue_type='uint16', keep_intermediates=True):
 
         self.input_path = input_path
         self.output_path = output_path
         self.want_tissues = want_tissues
         self.want_atlas = want_atlas
+        self.companion_paths = list(companion_paths or [])
+        self.preset_name = preset
+        self.preset = presets.get_preset(preset)
+        self.scratch_root = scratch_root
+        self.scratch_dir = None
+        self.cache = cache
+        self._cache_hashes = None
+        self._registered_hashes = None
+        self.in_memory = in_memory
+        if tissue_type not in nifti_io.PROBABILITY_TYPES:
+            raise ValueError('Unknown tissue type %s, choose from %s'
+                             % (tissue_type, ', '.join(sorted(nifti_io.PROBABILITY_TYPES))))
+        self.compression = int(compression)
+        self.tissue_type = tissue_type
+        self.keep_intermediates = keep_intermediates and not in_memory
+        self.out_ext = nifti_io.extension(self.compression)
+        # files for the registration tools are not compressed in memory mode
+        self.work_ext = ".nii" if in_memory else self.out_ext
 
         self.name = os.path.splitext(os.path.splitext(os.path.basename(input_path))[0])[0]
-        self.atlas = utils.get_relative_path("Atlas")
-        self.ss_sh_path = utils.get_relative_path(os.path.join("sh", "skull_strip.sh"))
-
-    # Deformable registration of the stripped atlas to the anatomy using NiftyReg
-    # @param atlas_path : path to the skull stripped atlas
-    # @param anatomy_path : path to the stripped modality
-    def deformable_registration(self, atlas_path, anatomy_path):
-        print("\n Deformable tissue registration started \n -----------------")
-        aff_reg = utils.get_relative_path('t1_atlas_aff_reg.nii.gz')
-        aff_trans = utils.get_relative_path('t1_atlas_aff_transformation.txt')
-        f3d_cpp = utils.get_relative_path('t1_atlas_f3d_cpp.nii.gz')
-        f3d_reg = utils.get_relative_path(self.name + '_atlas_reg_deform.nii.gz')
-        tissue_reg = utils.get_relative_path(os.path.join(self.output_path, self.name))
-        tissueAtlas = utils.get_relative_path(os.path.join(self.output_path, self.name + '_'))
-
-        reg.niftireg_affine_registration(atlas_path, anatomy_path, transform_path=aff_trans, result_path=aff_reg)
-        reg.niftireg_nonrigid_registration(atlas_path, anatomy_path, transform_path=aff_trans, cpp_path=f3d_cpp,
-                                           result_path=f3d_reg)
-
-        # Apply tranfromaton to the brain tissue
-        for tissue in ["csf", "gm", "wm"]:
-            reg.niftireg_transform(tissueAtlas + tissue + ".nii.gz", anatomy_path, f3d_cpp,
-                                   result_path=tissue_reg + "_" + tissue + "temp.nii.gz", cpp=True)
-            img = nib.load(tissue_reg + "_" + tissue + "temp.nii.gz")
-            mask = math_img('(img - np.min(img))/(np.max(img)-np.min(img))', img=img)
-            nib.save(mask, tissue_reg + "_" + tissue + "temp.nii.gz")
-            os.remove(tissueAtlas + tissue + ".nii.gz")
-            os.rename(tissueAtlas + tissue + "temp.nii.gz", tissueAtlas + tissue + ".nii.gz")
-            print("%s image is saved to: %s" % (tissue, tissueAtlas + tissue + ".nii.gz"))
-
-        # Apply transformation to brain mask
-        basicMaskPath = os.path.join(self.output_path, self.name + "_mask.nii.gz")
-        refinedMaskPath = os.path.join(self.output_path, self.name + "_mask_refined_reg.nii.gz")
-        reg.niftireg_transform(basicMaskPath, anatomy_path, f3d_cpp, result_path=refinedMaskPath, cpp=True)
-
-        os.remove(aff_reg)
-        os.remove(aff_trans)
-        os.remove(f3d_cpp)
-
-        if self.want_atlas:
-            regAtlasPath = os.path.join(self.output_path, self.name + "_atlas_reg_deform.nii.gz")
-            os.rename(f3d_reg, regAtlasPath)
-        else:
-            os.remove(f3d_reg)
+        if atlas_dir is None:
+            atlas_dir = paths.ATLAS_DIR
+        self.atlas = os.path.abspath(atlas_dir)
+        pack_path = os.path.join(self.atlas, os.path.basename(paths.ATLAS_PACK))
+        if os.path.isfile(self.atlas):
+            pack_path = self.atlas
+        self.atlas_pack = atlas.load_pack(pack_path) if os.path.isfile(pack_path) else None
+        # intermediate files kept until the run finished, for resuming (in the scratch root, off the output disk)
+        self.work_dir = scratch.get_work_dir(scratch_root, input_path, output_path)
+        # output of the registration tools, kept with the work folder if the run fails
+        log_path = os.path.join(self.work_dir, "registration.log")
+        self.backends = {'rigid': backends.get_backend(rigid_backend, log_path=log_path),
+                         'deformable': backends.get_backend(deformable_backend, log_path=log_path)}
+        # files produced by the stages so far (None if only kept in memory)
+        self.files = {}
+        # images kept in memory
+        self.images = {}
+        # bounding box of the brain in the input, see _brain_box
+        self.brain_box = None
+        # timing and resource usage of the stages, see profiling.RunReport
+        self.report = None
+
+    # Cache key of a registration stage: input scan, atlas and stage parameters
+    # @param stage : name of the registration stage
+    # @param params : parameters the stage result depends on
+    def _cache_key(self, stage, *params):
+        if self._cache_hashes is None:
+            if self.atlas_pack is not None:
+                atlas_hash = self.atlas_pack.checksum
+            else:
+                atlas_hash = reg_cache.hash_files([os.path.join(self.atlas, f) for f in ATLAS_FILES])
+            self._cache_hashes = (reg_cache.hash_image(self.input_path), atlas_hash)
+        return self.cache.key(stage, *(self._cache_hashes + params))
+
+    # Cache parameters of the registrations of the skull stripped atlas. Their inputs depend on the rigid stage,
+    # the basic mask and the brain box, so they are keyed by the content of the inputs.
+    # @param backend : backend of the registrations
+    def _registered_params(self, backend):
+        if self.cache is None:
+            return ()
+        if self._registered_hashes is None:
+            self._registered_hashes = tuple(reg_cache.hash_image(self.files[key])
+                                            for key in ['reg_atlas', 'reg_anatomy'])
+        return (backend.name,) + self._registered_hashes
+
+    # Copy the results of a registration stage from the cache
+    # @param stage : name of the registration stage
+    # @param files : maps cached file names to destination paths
+    # @return True if the stage was cached
+    def _fetch_cached(self, stage, files, *params):
+        if self.cache is None:
+            return False
+        if not self.cache.fetch(self._cache_key(stage, *params), files):
+            return False
+        print("Using cached %s registration \n" % stage)
+        return True
+
+    # Store the results of a registration stage in the cache
+    # @param stage : name of the registration stage
+    # @param files : maps cached file names to the result paths
+    def _store_cached(self, stage, files, *params):
+        if self.cache is not None and all(os.path.isfile(path) for path in files.values()):
+            self.cache.store(self._cache_key(stage, *params), files)
 
     # Apply a mask to the modality
     # @param anatomy_path : Path to the input modality
-    # @param mask_path : Path to the brain mask
+    # @param mask_path : Path to the brain mask, or the loaded brain mask
     # @param output_name: output name of the stripped modality
-    def apply_mask(self, image_path, mask_path, output_name):
-        mask = nib.load(os.path.join(self.output_path, mask_path))
-        patient = nib.load(image_path)
-
-        # Reshape (in some cases data resolution is (x,y,z,1), reshape removes the 4th dimension
-        tmp1 = patient.get_data()
-        res = tmp1.shape
-        tmp2 = tmp1.reshape(res[0], res[1], res[2])
-
-        masked_data = np.multiply(tmp2, mask.get_data())
-        # masked_data = np.multiply(patient.get_data(), mask.get_data())
-        masked_data = nib.Nifti1Image(masked_data, patient.affine, patient.header)
-        path_to_save = utils.get_relative_path(os.path.join(self.output_path, output_name + ".nii.gz"))
-        nib.save(masked_data, path_to_save)
+    # @param save_dir : Folder of the stripped modality, the output folder by default
+    # @param extension : File extension of the stripped modality, by default that of the outputs
+    def apply_mask(self, image_path, mask_path, output_name, save_dir=None, extension=None):
+        if isinstance(mask_path, str):
+            mask = nifti_io.load(os.path.join(self.output_path, mask_path))
+        else:
+            mask = mask_path
+
+        if save_dir is None:
+            save_dir = self.output_path
+        if extension is None:
+            extension = self.out_ext
+        path_to_save = utils.get_relative_path(os.path.join(save_dir, output_name + extension))
+        # the image is read and written slab by slab, (x,y,z,1) images loose their 4th dimension
+        with checkpoint.atomic_path(path_to_save) as tmp_path:
+            nifti_io.apply_mask_streaming(image_path, mask, tmp_path, compresslevel=self.compression)
         return path_to_save
 
+    # Path of an output file
+    # @param suffix : appended to the name of the input
+    def _output(self, suffix):
+        return os.path.join(self.output_path, self.name + suffix)
+
+    # Atlas channel ('t1', 'mask', 'wm', 'gm' or 'csf') as an image, from the atlas pack if there is one
+    # @param level : pyramid level of the atlas pack
+    def _atlas_image(self, channel, level=0):
+        if self.atlas_pack is not None:
+            return self.atlas_pack.image(channel, level)
+        return nib.load(os.path.join(self.atlas, 'atlas_%s.nii' % channel))
+
+    # Path of the atlas T1 for the registration tools
+    # @param voxel_size : voxel size (mm) of the registered image, None for full resolution
+    def _atlas_t1_path(self, voxel_size=None):
+        if self.atlas_pack is None:
+            return os.path.join(self.atlas, 'atlas_t1.nii')
+        return self.atlas_pack.save('t1', self.scratch_dir.path("atlas_t1.nii"), self.atlas_pack.level_for(voxel_size))
+
+    # Bounding box of the basic mask grown by BRAIN_CROP_MARGIN, the registrations of the skull stripped
+    # atlas run on this box and their results are pasted back into the full field of view
+    def _brain_box(self):
+        if self.brain_box is None:
+            mask = self._load('mask_basic')
+            pad = int(np.ceil(BRAIN_CROP_MARGIN / min(mask.header.get_zooms()[:3])))
+            self.brain_box = roi.bounding_box(np.asanyarray(mask.dataobj), pad)
+        return self.brain_box
+
+    # Paste an image of the brain box back into the grid of the input
+    # @param img : image on the grid of the brain box
+    # @param dtype : data type of the pasted image
+    def _uncrop(self, img, dtype=None):
+        return roi.paste(img, nib.load(self.input_path), self._brain_box(), dtype)
+
+    # Path of an intermediate file in the work folder
+    def _work(self, file_name):
+        return os.path.join(self.work_dir, file_name)
+
+    # Keep an image produced by a stage
+    # @param key : name of the image
+    # @param img : the image
+    # @param path : Path to save the image to, None to keep it only in memory
+    # @param probabilities : Save the image as probabilities in the tissue data type
+    # @return path
+    def _keep(self, key, img, path=None, probabilities=False):
+        if self.in_memory:
+            self.images[key] = img
+        if path is not None:
+            self._save(img, path, probabilities)
+        return path
+
+    # Save an image with the output encoding, see nifti_io.save
+    # @param img : the image, masks as uint8
+    # @param path : Path to save the image to
+    # @param probabilities : Save the image as probabilities in the tissue data type
+    def _save(self, img, path, probabilities=False):
+        slope = 1.
+        if probabilities:
+            data, slope = nifti_io.quantize(np.asanyarray(img.dataobj), nifti_io.PROBABILITY_TYPES[self.tissue_type])
+            img = nib.Nifti1Image(data, img.affine, img.header)
+        with checkpoint.atomic_path(path) as tmp_path:
+            nifti_io.save(img, tmp_path, slope, self.compression)
+        return path
+
+    # Image produced by an earlier stage, from memory if possible
+    # @param key : name of the image
+    def _load(self, key):
+        if key in self.images:
+            return self.images[key]
+        return nifti_io.load(self.files[key])
+
+    # Description of the run, a manifest of a different run is not resumed
+    def _run_info(self):
+        stat = os.stat(self.input_path)
+        return {'input': os.path.abspath(self.input_path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'atlas': self.atlas, 'want_tissues': bool(self.want_tissues), 'want_atlas': bool(self.want_atlas),
+                'in_memory': bool(self.in_memory), 'preset': self.preset_name,
+                'compression': self.compression, 'tissue_type': self.tissue_type,
+                'keep_intermediates': bool(self.keep_intermediates),
+                'backends': dict((stage, backend.name) for stage, backend in self.backends.items()),
+                'companions': [os.path.abspath(path) for path in self.companion_paths]}
+
     def strip_skull(self):
 
-        """ Perform skull stripping"""
+        """ Perform skull stripping, resuming an interrupted run of the same input """
         print("Skull stripping started. \n --------------------------- \n")
         print("Input Modality: %s \n" % self.input_path)
         print("Output Folder : %s \n" % self.output_path)
 
-        # 1) Rigid registration of Atlas to Patient -> basic mask + tissue approximations
+        # fail before the registrations if a companion modality can't share the mask
+        input_shape = nib.load(self.input_path).shape[:3]
+        for companion_path in self.companion_paths:
+            print("Companion Modality: %s \n" % companion_path)
+            if nib.load(companion_path).shape[:3] != input_shape:
+                raise ValueError(companion_path + ' is not co-registered with ' + self.input_path)
+
+        for folder in [self.output_path, self.work_dir]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        manifest = checkpoint.Manifest(self._work("manifest.json"), self._run_info())
+
+        self.report = profiling.RunReport(**self._run_info())
+        try:
+            with scratch.ScratchDir(self.scratch_root) as scratch_dir:
+                self.scratch_dir = scratch_dir
+                try:
+                    for stage in STAGES:
+                        self._run_stage(manifest, stage)
+                finally:
+                    self.scratch_dir = None
+        except Exception as e:
+            self.report.error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            self.report.save(self._output("_s3_report.json"))
+
+        shutil.rmtree(self.work_dir)
+        print('---------------------------\nSkull Stripping Finished.')
+
+    # Run a stage, unless an earlier run completed it
+    # @param manifest : Manifest of the completed stages
+    # @param stage : name of the stage (see STAGES)
+    def _run_stage(self, manifest, stage):
+        if manifest.is_complete(stage):
+            print("Stage %s was completed by an earlier run \n" % stage)
+            self.files.update(manifest.outputs(stage))
+            self.report.skip(stage)
+            return
+
+        # the following stages depend on this one
+        manifest.reset(STAGES[STAGES.index(stage):])
+        with self.report.stage(stage):
+            outputs = getattr(self, '_' + stage.replace('-', '_'))()
+        self.files.update(outputs)
+        manifest.complete(stage, outputs)
+
+    # 1) Rigid registration of Atlas to Patient -> basic mask + tissue approximations
+    def _rigid(self):
         print("\nCompute basic mask: \n -----------------")
-        moving_image = self.atlas
-        fixed_image = self.input_path
-        command = shlex.split(
-            "%s %s %s %s %s" % (self.ss_sh_path, fixed_image, moving_image, self.output_path, self.name))
-        stripping = subprocess.call(command)
-
-        # make the mask binary
-        atlas_reg_path = os.path.join(self.output_path, self.name + "_atlas_reg.nii")
-        basic_mask_path = os.path.join(self.output_path, self.name + "_mask.nii.gz")
-        mask = nib.load(os.path.join(basic_mask_path))
-        mask = math_img('img > 0.9', img=mask)
-        nib.save(mask, basic_mask_path)
-
-        # 2) deformable registration between skull stripper atlas and skull strip patient (use the basic mask)
-        # stripping = subprocess.call(command)
-        stripped_atlas = self.apply_mask(atlas_reg_path, self.name + "_mask.nii.gz", "masked_atlas")
-        stripped_image = self.apply_mask(fixed_image, self.name + "_mask.nii.gz", self.name + "_masked_basic")
-        self.deformable_registration(stripped_atlas, stripped_image)
-
-        # rename the first mask
-        os.rename(basic_mask_path, os.path.join(self.output_path, self.name + "_mask_basic.nii.gz"))
-
-        # 3) Compute new mask from the tissue approximations
+        backend = self.backends['rigid']
+        transform = self.scratch_dir.path("rigid_transformation" + backend.AFFINE_EXTENSION)
+        cached_transform = {'transformation' + backend.AFFINE_EXTENSION: transform}
+        rigid_params = (backend.name, self.preset['voxel_size'], self.preset['initializer'],
+                        self.preset['ants_iterations'], self.preset['ants_moment_iterations'],
+                        self.preset['aladin_params'])
+
+        if not self._fetch_cached('rigid', cached_transform, *rigid_params):
+            fixed_image = self.input_path
+            if self.preset['voxel_size'] is not None:
+                # register a downsampled copy of the head, the transformation is applied at full resolution
+                img = nib.load(self.input_path)
+                low_res = roi.downsample(roi.crop(img, roi.head_bounding_box(img)), self.preset['voxel_size'])
+                fixed_image = self.scratch_dir.path("input_low_res.nii")
+                nib.save(low_res, fixed_image)
+            atlas_t1 = self._atlas_t1_path(self.preset['voxel_size'])
+            initial = None
+            if self.preset['initializer'] == 'moments':
+                # start from the pose matching the centers of mass and principal axes of the heads
+                initial = moments.moment_alignment(nib.load(fixed_image), nib.load(atlas_t1))
+            backend.affine(atlas_t1, fixed_image, transform, preset=self.preset, initial=initial)
+            self._store_cached('rigid', cached_transform, *rigid_params)
+
+        # apply the transformation to the atlas, the brain mask and the brain tissue, all in one pass
+        registered = {'atlas_reg': 't1', 'mask_reg': 'mask'}
+        for tissue in TISSUES:
+            registered[tissue + '_rigid'] = tissue
+        keys = sorted(registered)
+        atlas_images = [self._atlas_image(registered[key]) for key in keys]
+        resampled = transforms.resample_affine(atlas_images, nib.load(self.input_path),
+                                               backend.read_affine(transform))
+
+        outputs = {}
+        for key, img in zip(keys, resampled):
+            # the files are needed by the registration tools and for resuming
+            outputs[key] = self._keep(key, img, self._work(key + self.work_ext))
+        return outputs
+
+    # Make the registered atlas mask binary
+    def _basic_mask(self):
+        registered = self._load('mask_reg')
+        mask = nib.Nifti1Image(masks.threshold(np.asanyarray(registered.dataobj), BASIC_MASK_THRESHOLD),
+                               registered.affine, registered.header)
+        mask.set_data_dtype(np.uint8)
+        return {'mask_basic': self._keep('mask_basic', mask, self._output("_mask_basic" + self.out_ext))}
+
+    # 2) deformable registration between skull stripped atlas and skull stripped patient (use the basic mask)
+    def _masking(self):
+        mask = self._load('mask_basic')
+        stripped_atlas = self.apply_mask(self.files['atlas_reg'], mask, "masked_atlas",
+                                         save_dir=self.work_dir, extension=self.work_ext)
+        if not self.keep_intermediates:
+            # only needed by the registration tools
+            stripped_image = self.apply_mask(self.input_path, mask, "masked_basic",
+                                             save_dir=self.work_dir, extension=self.work_ext)
+        else:
+            stripped_image = self.apply_mask(self.input_path, mask, self.name + "_masked_basic")
+        outputs = {'masked_atlas': stripped_atlas, 'masked_basic': stripped_image}
+
+        # images for the deformable registrations: cropped to the brain, downsampled by the fast preset
+        # (reg_reference is the grid the deformable transformation is applied on)
+        box = self._brain_box()
+        for key, path in [('reg_atlas', stripped_atlas), ('reg_reference', stripped_image)]:
+            outputs[key] = self._work(key + self.work_ext)
+            checkpoint.atomic_save(roi.crop(nib.load(path), box), outputs[key])
+        outputs['reg_anatomy'] = outputs['reg_reference']
+        if self.preset['voxel_size'] is not None:
+            for key in ['reg_atlas', 'reg_anatomy']:
+                low_res = roi.downsample(nib.load(outputs[key]), self.preset['voxel_size'])
+                outputs[key] = self._work(key + "_low_res.nii")
+                checkpoint.atomic_save(low_res, outputs[key])
+        return outputs
+
+    # Affine registration of the stripped atlas to the stripped anatomy
+    def _affine(self):
+        print("\n Deformable tissue registration started \n -----------------")
+        backend = self.backends['deformable']
+        aff_trans = self.scratch_dir.path('aff_transformation' + backend.AFFINE_EXTENSION)
+        cached_transform = {'aff' + backend.AFFINE_EXTENSION: aff_trans}
+
+        aff_params = self._registered_params(backend) + (self.preset['ants_iterations'], self.preset['aladin_params'])
+        if not self._fetch_cached('affine', cached_transform, *aff_params):
+            backend.affine(self.files['reg_atlas'], self.files['reg_anatomy'], aff_trans, preset=self.preset)
+            self._store_cached('affine', cached_transform, *aff_params)
+
+        outputs = {'aff_transformation': self._work('aff_transformation' + backend.AFFINE_EXTENSION)}
+        checkpoint.publish(aff_trans, outputs['aff_transformation'])
+        return outputs
+
+    # Deformable registration of the stripped atlas to the stripped anatomy
+    def _nonrigid(self):
+        backend = self.backends['deformable']
+        # control point grids are read by the tools again: not compressed in memory mode
+        extension = backend.nonrigid_extension(self.work_ext)
+        transform = self.scratch_dir.path('nonrigid_transformation' + extension)
+        cached_transform = {'nonrigid' + extension: transform}
+        atlas_deform = self.scratch_dir.path(self.name + '_atlas_reg_deform' + self.work_ext)
+
+        # the affine transformation it starts from is keyed by the same inputs
+        nonrigid_params = self._registered_params(backend) + (self.preset['ants_iterations'],
+                                                              self.preset['aladin_params'],
+                                                              self.preset['syn_iterations'],
+                                                              self.preset['f3d_params'], extension)
+        deform_atlas = self.want_atlas
+        if not self._fetch_cached('nonrigid', cached_transform, *nonrigid_params):
+            backend.nonrigid(self.files['reg_atlas'], self.files['reg_anatomy'], self.files['aff_transformation'],
+                             transform, result_path=atlas_deform, preset=self.preset)
+            self._store_cached('nonrigid', cached_transform, *nonrigid_params)
+            # the registration result is the deformed atlas, unless it was registered downsampled
+            deform_atlas = self.want_atlas and self.preset['voxel_size'] is not None
+
+        if deform_atlas:
+            backend.resample(self.files['masked_atlas'], self.files['reg_reference'], transform, atlas_deform)
+
+        outputs = {'nonrigid_transformation': self._work('nonrigid_transformation' + extension)}
+        checkpoint.publish(transform, outputs['nonrigid_transformation'])
+        if self.want_atlas:
+            outputs['atlas_reg_deform'] = self._output("_atlas_reg_deform" + self.out_ext)
+            self._save(self._uncrop(nib.load(atlas_deform)), outputs['atlas_reg_deform'])
+        return outputs
+
+    # Apply the deformable transformation to the brain tissue and to the brain mask
+    def _resample(self):
+        backend = self.backends['deformable']
+        anatomy_path = self.files['reg_reference']
+        transform = self.files['nonrigid_transformation']
+
+        # the calls are independent, run them concurrently
+        jobs = []
+        for tissue in TISSUES:
+            jobs.append((self.files[tissue + '_rigid'], anatomy_path, transform,
+                         self.scratch_dir.path(tissue + "_temp" + self.work_ext)))
+        # the registered basic mask is an intermediate output only
+        refined_reg = self.scratch_dir.path("mask_refined_reg" + self.work_ext)
+        if self.keep_intermediates:
+            jobs.append((self.files['mask_basic'], anatomy_path, transform, refined_reg))
+        backend.resample_many(jobs)
+
+        # the results cover the brain box, paste them into the full field of view
+        outputs = {}
+        if self.keep_intermediates:
+            outputs['mask_refined_reg'] = self._output("_mask_refined_reg" + self.out_ext)
+            self._save(self._uncrop(nib.load(refined_reg), np.float32), outputs['mask_refined_reg'],
+                       probabilities=True)
+        for tissue in TISSUES:
+            img = self._uncrop(nib.load(self.scratch_dir.path(tissue + "_temp" + self.work_ext)), np.float32)
+            mask = nib.Nifti1Image(masks.normalize(np.asanyarray(img.dataobj)), img.affine, img.header)
+            if self.want_tissues:
+                tissue_path = self._output("_" + tissue + self.out_ext)
+                print("%s image is saved to: %s" % (tissue, tissue_path))
+            elif self.in_memory:
+                tissue_path = None
+            else:
+                tissue_path = self._work(tissue + self.out_ext)
+            outputs[tissue] = self._keep(tissue, mask, tissue_path, probabilities=True)
+            # the refined mask is computed from the maps before quantization (unless resumed)
+            self.images[tissue] = mask
+        return outputs
+
+    # 3) Compute new mask from the tissue approximations
+    def _refine(self):
         print("\nComputing refined mask \n -------------")
-        wm_path = os.path.join(self.output_path, self.name + "_wm.nii.gz")
-        gm_path = os.path.join(self.output_path, self.name + "_gm.nii.gz")
-        csf_path = os.path.join(self.output_path, self.name + "_csf.nii.gz")
-        basic_mask_path = os.path.join(self.output_path, self.name + "_mask_basic.nii.gz")
-
-        wm = nib.load(wm_path)
-        gm = nib.load(gm_path)
-        csf = nib.load(csf_path)
-        basic_mask = nib.load(basic_mask_path)
+        wm = self._load('wm')
+        gm = self._load('gm')
+        csf = self._load('csf')
+        basic_mask = self._load('mask_basic')
 
         # soft mask + remove background
-        soft_mask = np.add(wm.get_data(), gm.get_data())
-        soft_mask = np.add(soft_mask, csf.get_data())
-        soft_mask = np.multiply(soft_mask, basic_mask.get_data())
-
-        # background = np.min(soft_mask)
-        # soft_mask[ soft_mask <= 2* background] = 0
-
-        soft_mask = nib.Nifti1Image(soft_mask, wm.affine, wm.header)
-        path_to_save = utils.get_relative_path(os.path.join(self.output_path, self.name + "_mask_soft.nii.gz"))
-        nib.save(soft_mask, path_to_save)
-
-        # cut outliers from the soft mask
-        data = np.reshape(soft_mask.get_data(), (1, np.product(soft_mask.get_data().shape)))
-        dataNN = data[data != 0]
-        m = np.mean(dataNN)
-        s = np.std(dataNN)
-        LB = m - 3.0 * s
-        refined_mask = soft_mask.get_data()
-        refined_mask[refined_mask < LB] = 0
-        refined_mask[refined_mask >= LB] = 1
+        # (quantized tissue maps are scaled to float32 as they are read)
+        tissues = [img.get_fdata(dtype=np.float32, caching='unchanged') for img in (wm, gm, csf)]
+        soft_mask = masks.fuse_tissues(tissues, np.asanyarray(basic_mask.dataobj))
+
+        soft_mask_path = None
+        if self.keep_intermediates:
+            # the sum of the tissue probabilities, up to 3: saved as float
+            soft_mask_path = self._output("_mask_soft" + self.out_ext)
+            self._save(nib.Nifti1Image(soft_mask, wm.affine, wm.header), soft_mask_path)
+
+        # cut outliers from the soft mask, as a uint8 mask
+        refined_mask = masks.refine_mask(soft_mask, n_sigma=REFINED_MASK_SIGMAS)
         refined_mask = nib.Nifti1Image(refined_mask, wm.affine, wm.header)
-        path_to_save_mask = utils.get_relative_path(os.path.join(self.output_path, self.name + "_mask.nii.gz"))
-        nib.save(refined_mask, path_to_save_mask)
+        mask_path = self._keep('mask', refined_mask, self._output("_mask" + self.out_ext))
+        return {'mask_soft': soft_mask_path, 'mask': mask_path}
 
-        # 4) Apply the refine mask to image and to modalities
+    # 4) Apply the refine mask to image and to modalities
+    def _apply(self):
         print("Applying refined mask \n")
-        stripped_image = self.apply_mask(fixed_image, self.name + "_mask.nii.gz", self.name + "_masked")
+        mask = self._load('mask')
+        stripped_image = self.apply_mask(self.input_path, mask, self.name + "_masked")
         print("Results save as %s \n" % stripped_image)
-
-        if not self.want_tissues:
-            os.remove(wm_path)
-            os.remove(gm_path)
-            os.remove(csf_path)
-
-        # Clean up
-        os.remove(stripped_atlas)
-        os.remove(os.path.join(self.output_path, self.name + "_atlas_reg.nii"))
-        os.remove(os.path.join(self.output_path, self.name + "_atlas_reg.nii0GenericAffine.mat"))
-
-        print('---------------------------\nSkull Stripping Finished.')
+        outputs = {'masked': stripped_image}
+
+        # the companion modalities share the mask of the input, no registration needed
+        for companion_path in self.companion_paths:
+            companion_name = os.path.splitext(os.path.splitext(os.path.basename(companion_path))[0])[0]
+            stripped_companion = self.apply_mask(companion_path, mask, companion_name + "_masked")
+            print("Results save as %s \n" % stripped_companion)
+            outputs['masked_' + companion_name] = stripped_companion
+        return outputs
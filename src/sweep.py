@@ -0,0 +1,110 @@
+"""
+Sweep of the refined mask cutoff.
+
+The refined mask keeps the voxels of the soft mask above a lower bound,
+REFINED_MASK_SIGMAS standard deviations below the mean of its nonzero
+voxels (see skull.py). The sweep evaluates many cutoffs, in standard
+deviations or as percentiles of the nonzero voxels, on the soft mask
+saved by a run, without repeating the registrations: the soft mask is
+sorted once and the voxel count of every cutoff is found by binary
+search (see masks.sweep_cutoffs). The masks themselves are only written
+on request.
+
+The basic mask threshold can't be swept this way: the soft mask, and the
+deformable registrations it comes from, depend on the basic mask.
+
+Usage:
+    python s3.py --sweep output/t1_mask_soft.nii.gz --sigmas 2,2.5,3,3.5 --percentiles 1,5 [--sweep-masks]
+"""
+from __future__ import division
+import json
+import os
+import numpy as np
+import nibabel as nib
+from . import checkpoint
+from . import masks
+from . import nifti_io
+
+# Cutoffs (standard deviations below the mean) swept if none are given
+DEFAULT_SIGMAS = [1., 1.5, 2., 2.5, 3., 3.5, 4.]
+SOFT_MASK_SUFFIX = '_mask_soft'
+
+
+def _prefix(soft_mask_path):
+    """ Path of the soft mask without its suffix and extension. """
+
+    base = soft_mask_path
+    for extension in ['.gz', '.nii']:
+        if base.endswith(extension):
+            base = base[:-len(extension)]
+    if base.endswith(SOFT_MASK_SUFFIX):
+        base = base[:-len(SOFT_MASK_SUFFIX)]
+    return base
+
+
+def run_sweep(soft_mask_path, n_sigmas=None, percentiles=None, save_masks=False,
+              compression=nifti_io.COMPRESS_LEVEL):
+    """ Evaluate the cutoffs on a saved soft mask, save the results as
+    <name>_mask_sweep.json next to it, and return them.
+
+    Parameters
+    ----------
+    soft_mask_path : str
+        the _mask_soft output of a run
+    n_sigmas : list of float
+        cutoffs in standard deviations below the mean, DEFAULT_SIGMAS if
+        neither n_sigmas nor percentiles are given
+    percentiles : list of float
+        cutoffs as percentiles of the nonzero voxels
+    save_masks : bool
+        also write the mask of every cutoff, as <name>_mask_sigma<n> or
+        <name>_mask_pct<p>
+    compression : int
+        zlib compression level of the masks, 0 for .nii files
+    """
+
+    if not n_sigmas and not percentiles:
+        n_sigmas = DEFAULT_SIGMAS
+    n_sigmas = list(n_sigmas or [])
+    percentiles = list(percentiles or [])
+
+    img = nib.load(soft_mask_path)
+    soft_mask = img.get_fdata(dtype=np.float32)
+    bounds, counts = masks.sweep_cutoffs(soft_mask, n_sigmas, percentiles)
+    voxel_ml = float(np.prod(img.header.get_zooms()[:3])) / 1000.
+
+    prefix = _prefix(soft_mask_path)
+    basic_voxels = None
+    for extension in ['.nii.gz', '.nii']:
+        if os.path.isfile(prefix + '_mask_basic' + extension):
+            basic_voxels = int(np.count_nonzero(np.asanyarray(nib.load(prefix + '_mask_basic' + extension).dataobj)))
+            break
+
+    labels = ['sigma%g' % n for n in n_sigmas] + ['pct%g' % p for p in percentiles]
+    results = []
+    for label, bound, count in zip(labels, bounds, counts):
+        result = {'cutoff': label, 'lower_bound': float(bound), 'voxels': int(count),
+                  'volume_ml': int(count) * voxel_ml}
+        if basic_voxels:
+            result['basic_fraction'] = int(count) / basic_voxels
+        if save_masks:
+            mask = np.greater_equal(soft_mask, np.float32(bound)).astype(np.uint8)
+            result['path'] = prefix + '_mask_' + label + nifti_io.extension(compression)
+            with checkpoint.atomic_path(result['path']) as tmp_path:
+                nifti_io.save(nib.Nifti1Image(mask, img.affine, img.header), tmp_path, compresslevel=compression)
+        results.append(result)
+
+    with open(prefix + '_mask_sweep.json', 'w') as f:
+        json.dump({'soft_mask': os.path.abspath(soft_mask_path), 'basic_voxels': basic_voxels,
+                   'cutoffs': results}, f, indent=2)
+    return results
+
+
+def print_sweep(results):
+    """ Print the lower bound and size of the mask of every cutoff. """
+
+    print("%-10s %12s %12s %12s %8s" % ('cutoff', 'lower bound', 'voxels', 'volume (ml)', 'basic'))
+    for result in results:
+        basic = '%.3f' % result['basic_fraction'] if 'basic_fraction' in result else '-'
+        print("%-10s %12.4f %12d %12.1f %8s" % (result['cutoff'], result['lower_bound'], result['voxels'],
+                                                result['volume_ml'], basic))
@@ -0,0 +1,124 @@
+"""
+Affine transformations of the registration tools, applied in-process.
+
+Reads and writes the affine transformations of antsRegistration (ITK .mat)
+and reg_aladin (.txt) as 4x4 matrices in RAS world coordinates, and
+resamples several images sharing a grid (e.g. the atlas T1, mask and
+tissue maps) onto a reference grid in one pass: the sampling coordinates
+are computed once per slab and shared by all images.
+
+Both tools store the transformation from the reference (fixed) space to
+the moving space, which is what resampling needs.
+
+Usage:
+    world = read_itk_affine('atlas_reg0GenericAffine.mat')
+    t1, mask = resample_affine([atlas_t1, atlas_mask], reference_img, world)
+"""
+from __future__ import division
+import numpy as np
+import nibabel as nib
+from scipy import io, ndimage
+
+# Number of slices (along the last axis of the reference) resampled at once
+SLAB_SIZE = 16
+# ITK works in LPS world coordinates, nifti in RAS
+LPS_TO_RAS = np.diag([-1., -1., 1., 1.])
+
+
+def read_itk_affine(path):
+    """ World (RAS) transformation from fixed to moving space of an ITK
+    affine transformation file (.mat) written by ANTs. """
+
+    content = io.loadmat(path)
+    name = [key for key in content if key.startswith('AffineTransform_')]
+    if len(name) != 1:
+        raise ValueError('%s is not an ITK affine transformation' % path)
+    parameters = content[name[0]].ravel().astype(np.float64)
+    center = content['fixed'].ravel().astype(np.float64) if 'fixed' in content else np.zeros(3)
+
+    # y = M (x - c) + c + t in LPS coordinates
+    matrix = parameters[:9].reshape(3, 3)
+    translation = parameters[9:12]
+    lps = np.eye(4)
+    lps[:3, :3] = matrix
+    lps[:3, 3] = translation + center - matrix.dot(center)
+
+    return LPS_TO_RAS.dot(lps).dot(LPS_TO_RAS)
+
+
+def read_niftyreg_affine(path):
+    """ World (RAS) transformation from reference to floating space of a
+    reg_aladin affine transformation file (.txt). """
+
+    return np.loadtxt(path).reshape(4, 4)
+
+
+def write_itk_affine(world, path):
+    """ Write a world (RAS) transformation from fixed to moving space as an
+    ITK affine transformation file (.mat), e.g. to initialize
+    antsRegistration. """
+
+    lps = LPS_TO_RAS.dot(world).dot(LPS_TO_RAS)
+    parameters = np.concatenate([lps[:3, :3].ravel(), lps[:3, 3]]).reshape(12, 1)
+    io.savemat(path, {'AffineTransform_double_3_3': parameters, 'fixed': np.zeros((3, 1))}, format='4')
+    return path
+
+
+def write_niftyreg_affine(world, path):
+    """ Write a world (RAS) transformation from reference to floating space
+    as a reg_aladin affine transformation file (.txt). """
+
+    np.savetxt(path, world)
+    return path
+
+
+def resample_affine(images, reference, world, order=1, dtype=np.float32):
+    """ Resample images onto the grid of a reference image.
+
+    Parameters
+    ----------
+    images : list of nibabel images
+        3D images sharing the same grid (shape and affine)
+    reference : nibabel image
+        image defining the output grid
+    world : array
+        4x4 world transformation from the reference to the images' space,
+        see read_itk_affine and read_niftyreg_affine
+    order : int
+        spline order of the interpolation, 1 for linear
+    dtype :
+        data type of the results
+
+    Returns a list of nibabel images on the reference grid, zero outside
+    of the field of view of the images.
+    """
+
+    shape = reference.shape[:3]
+    grid_affine = images[0].affine
+    for img in images[1:]:
+        if img.shape[:3] != images[0].shape[:3] or not np.allclose(img.affine, grid_affine):
+            raise ValueError('The images to resample in one pass must share their grid')
+
+    # reference voxel -> moving voxel
+    voxel_map = np.linalg.inv(grid_affine).dot(world).dot(reference.affine)
+    data = [np.asanyarray(img.dataobj).reshape(img.shape[:3]) for img in images]
+    if order > 1:
+        # the spline coefficients are computed once, not for every slab
+        data = [ndimage.spline_filter(channel, order=order, output=np.float64) for channel in data]
+    results = [np.empty(shape, dtype=dtype) for _ in images]
+
+    for start in range(0, shape[2], SLAB_SIZE):
+        stop = min(start + SLAB_SIZE, shape[2])
+        voxels = np.mgrid[0:shape[0], 0:shape[1], start:stop].reshape(3, -1)
+        coordinates = voxel_map[:3, :3].dot(voxels) + voxel_map[:3, 3:]
+        for channel, result in zip(data, results):
+            values = ndimage.map_coordinates(channel, coordinates, output=dtype, order=order,
+                                             mode='constant', cval=0., prefilter=False)
+            result[:, :, start:stop] = values.reshape(shape[0], shape[1], stop - start)
+
+    resampled = []
+    for result in results:
+        img = nib.Nifti1Image(result, reference.affine)
+        img.header.set_xyzt_units(*reference.header.get_xyzt_units())
+        resampled.append(img)
+    return resampled